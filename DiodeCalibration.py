@@ -21,7 +21,8 @@ class Worker(QThread):
     dataSig = pyqtSignal(list)
     errorSig = pyqtSignal(str)
 
-    def __init__(self, Kthly:Keithley2000, FreqGen:FreqGenerator, freqRange:np.array, Umschalter:FreqUmschalter=None, timeout=0.05):
+    def __init__(self, Kthly:Keithley2000, FreqGen:FreqGenerator, freqRange:np.array, Umschalter:FreqUmschalter=None, timeout=0.05,
+                 listMode:bool=False, listTrigger:str="bus"):
         super(Worker, self).__init__()
 
         self.Kthly = Kthly
@@ -30,28 +31,43 @@ class Worker(QThread):
 
         self.freqRange = freqRange
         self.timeout = timeout
+        self.listMode = listMode # Step through freqRange from the generator's list memory
+        self.listTrigger = listTrigger # See FreqGenerator.startList
 
     def run(self) -> None:
         try:
             if self.Umschalter is not None:
                 zirkulators = self.Umschalter.freqRanges
 
+            if self.listMode:
+                pow = float(self.FreqGen.getPower())
+                self.FreqGen.loadList(self.freqRange, [pow] * len(self.freqRange))
+                self.FreqGen.startList(self.listTrigger)
+
             self.FreqGen.outputOn()
-            for freq in self.freqRange:
-                if self.Umschalter is not None:
-                    if not (26.0 < freq < 27.0) and not (freq > 40.0) and not (freq < 8.0):
-                        for key, range in zirkulators.items():
-                            if (range[0] <= freq <= range[1]):
-                                self.Umschalter.setZirkulator(freq)
-                self.FreqGen.setFreq(freq)
-                time.sleep(self.timeout)
+            for index, freq in enumerate(self.freqRange):
+                if self.listMode:
+                    # Learned list: the generator is already set up, only the circulator band change waits
+                    self.FreqGen.stepList(index, useUmschalter=self.Umschalter is not None)
+                else:
+                    if self.Umschalter is not None:
+                        if not (26.0 < freq < 27.0) and not (freq > 40.0) and not (freq < 8.0):
+                            for key, range in zirkulators.items():
+                                if (range[0] <= freq <= range[1]):
+                                    self.Umschalter.setZirkulator(freq)
+                    self.FreqGen.setFreq(freq)
+                    time.sleep(self.timeout)
                 val = self.Kthly.sense()
 
                 data = [float(freq), float(val)]
                 self.dataSig.emit(data)
             self.FreqGen.outputOff()
+            if self.listMode:
+                self.FreqGen.stopList()
         except Exception as e:
             self.FreqGen.outputOff()
+            if self.listMode:
+                self.FreqGen.stopList()
             self.errorSig.emit(e)
 
 
@@ -149,7 +165,7 @@ class MyForm(QMainWindow):
         self.ui.pushButtonStart.pressed.connect(self.startCalibration)
         self.ui.pushButtonLoad.pressed.connect(self.loadListe)
         self.Kthly = Keithley2000(stack.enter_context(rm.open_resource(kthlyAddr)))
-        self.FreqGen = FreqGenerator(stack.enter_context(rm.open_resource(RSFreq)))
+        self.FreqGen = FreqGenerator(stack.enter_context(rm.open_resource(RSFreq)), None) # Circulator set per scan
 
         self.FreqGen.outputOff()
 
@@ -193,6 +209,7 @@ class MyForm(QMainWindow):
             self.useUmschalter = self.ui.checkBoxUmschalter.isChecked()
             if self.useUmschalter:
                 self.Umschalter = FreqUmschalter(stack.enter_context(RedLabDigital(1)))
+            self.FreqGen.umschalter = self.Umschalter # Used by stepList in list mode
 
             try:
                 self.outputFile.close()
@@ -202,7 +219,9 @@ class MyForm(QMainWindow):
             name = "FrequenzListe" + "_" + self.now.strftime("%d-%m-%y_%H-%M-%S") + ".dat"
             self.outputFile = stack.enter_context(open(name, "x"))
 
-            self.thread = Worker(self.Kthly, self.FreqGen, self.freqRange, self.Umschalter)
+            self.thread = Worker(self.Kthly, self.FreqGen, self.freqRange, self.Umschalter,
+                                 listMode=config["R&S-Frequency Generator"].getboolean("List mode", False),
+                                 listTrigger=config["R&S-Frequency Generator"].get("List trigger", "bus"))
             self.thread.start()
             self.thread.dataSig.connect(self.updateData)
             self.thread.errorSig.connect(self.errorSignal)
@@ -0,0 +1,247 @@
+import numpy as np
+import queue
+import threading
+import time
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Column name -> header of the text format
+COLUMN_LABELS = {"field": "Magnetic Field [T]", "x": "X-Channel", "y": "Y-Channel", "phase": "Phase",
+                 "xVar": "X-Variance", "yVar": "Y-Variance", "passes": "Passes",
+                 "angle": "Angle [deg]", "freq": "Frequency [GHz]", "pow": "Power [dBm]"}
+
+COLUMN_TYPES = {"passes": "i4"} # Everything else is stored as float64
+
+
+class TextWriter:
+    # Tab separated .dat file, one line per point, as written by the measurement UI from the beginning
+    def __init__(self, path:str, columns:tuple, infos:dict=None, mode:str="x"):
+        self.path = path
+        self.columns = tuple(columns)
+        self.file = open(path, mode)
+        if mode != "a":
+            self.file.write("\t".join(COLUMN_LABELS[column] for column in self.columns) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, values:tuple):
+        self.file.write("\t".join(str(value) for value in values) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class HDF5Writer:
+    # Chunked binary output: one appendable, typed dataset per column in group "data", infos as attributes
+    # Points are collected in memory and appended to the datasets every chunkSize points (and on flush/close)
+    def __init__(self, path:str, columns:tuple, infos:dict=None, mode:str="x", chunkSize:int=256):
+        if h5py is None:
+            raise ImportError("h5py is needed to write HDF5 data files, install it or use the dat format")
+
+        self.path = path
+        self.columns = tuple(columns)
+        self.chunkSize = chunkSize
+        self.file = h5py.File(path, mode)
+
+        group = self.file.require_group("data")
+        self.datasets = {}
+        for column in self.columns:
+            if column not in group:
+                group.create_dataset(column, shape=(0,), maxshape=(None,), chunks=(chunkSize,),
+                                     dtype=COLUMN_TYPES.get(column, "f8"))
+            self.datasets[column] = group[column]
+        group.attrs["columns"] = list(self.columns)
+
+        if infos is not None and mode != "a":
+            self.writeInfos(infos)
+
+        self.buffer = []
+
+    def writeInfos(self, infos:dict):
+        for key, val in infos.items():
+            if isinstance(val, (str, int, float, bool, np.number)):
+                self.file.attrs[key] = val
+            elif isinstance(val, (list, tuple, np.ndarray)):
+                try:
+                    self.file.attrs[key] = np.asarray(val, dtype=float)
+                except (TypeError, ValueError):
+                    self.file.attrs[key] = str(val)
+            # Objects like the field calibration are not stored
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, values:tuple):
+        self.buffer.append(values)
+        if len(self.buffer) >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            block = np.array(self.buffer, dtype=float)
+            for index, column in enumerate(self.columns):
+                dataset = self.datasets[column]
+                start = dataset.shape[0]
+                dataset.resize((start + block.shape[0],))
+                dataset[start:] = block[:, index]
+            self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+
+
+class BufferedWriter(threading.Thread):
+    # Hands the points of the GUI thread to a background thread, so a slow disk (network share) can not block
+    # the event loop. Points are collected in a queue and written/flushed every flushInterval seconds or
+    # every flushCount points, whatever comes first. close() (also called by the ExitStack on a crash) writes
+    # everything that is still queued before closing the wrapped writer
+    # An optional Checkpoint is updated after every flush with the progress of the last flushed point,
+    # so it never points behind the data file and the measurement thread does no checkpoint file I/O
+    FLUSH = object()
+    FINISH = object()
+    STOP = object()
+
+    def __init__(self, writer, flushInterval:float=2.0, flushCount:int=100, checkpoint=None):
+        super().__init__(daemon=True)
+        self.writer = writer
+        self.checkpoint = checkpoint
+        self.path = writer.path
+        self.columns = writer.columns
+        self.flushInterval = flushInterval
+        self.flushCount = flushCount
+        self.queue = queue.Queue()
+        self.closed = False
+        self.error = None
+        self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, values:tuple, progress:dict=None) -> bool:
+        # progress: Checkpoint.update arguments of this point, stored once the point is flushed
+        # Returns False once the writer thread failed (see error), the point is dropped and the checkpoint
+        # stays at the last flushed point. Never raises, as it is called from Qt slots
+        if self.error is not None:
+            return False
+        self.queue.put((values, progress))
+        return True
+
+    def flush(self):
+        # Request a flush, done by the writer thread
+        self.queue.put(self.FLUSH)
+
+    def finish(self):
+        # Measurement completed: flush everything queued so far, then remove the checkpoint
+        self.queue.put(self.FINISH)
+
+    def run(self):
+        pending = 0
+        progress = None
+        lastFlush = time.monotonic()
+        stop = False
+        while not stop:
+            force = False
+            finished = False
+            try:
+                item = self.queue.get(timeout=self.flushInterval)
+            except queue.Empty:
+                item = None
+
+            try:
+                # Write everything that is waiting, then decide about flushing
+                while True:
+                    if item is self.STOP:
+                        stop = True
+                    elif item is self.FLUSH:
+                        force = True
+                    elif item is self.FINISH:
+                        force = finished = True
+                    elif item is not None:
+                        values, itemProgress = item
+                        self.writer.write(values)
+                        pending += 1
+                        if itemProgress is not None:
+                            progress = itemProgress
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                now = time.monotonic()
+                if pending and (stop or force or pending >= self.flushCount or now - lastFlush >= self.flushInterval):
+                    self.writer.flush()
+                    pending = 0
+                    lastFlush = now
+                    if self.checkpoint is not None and progress is not None:
+                        self.checkpoint.update(**progress)
+                    progress = None
+
+                if finished and self.checkpoint is not None:
+                    self.checkpoint.finish()
+                    self.checkpoint = None
+            except Exception as e:
+                print("Data writer error:", e)
+                self.error = e
+                return
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(self.STOP)
+        self.join()
+        try:
+            self.writer.close()
+        except Exception as e:
+            print("Closing " + self.path + " failed:", e)
+            if self.error is None:
+                self.error = e
+
+
+WRITERS = {"dat": TextWriter, "h5": HDF5Writer}
+
+
+def openDataWriter(path:str, columns:tuple, infos:dict=None, fmt:str="dat", mode:str="x"):
+    # fmt is the file extension: "dat" (text) or "h5" (HDF5); mode "x" creates a new file, "a" appends
+    try:
+        return WRITERS[fmt](path, columns, infos, mode)
+    except KeyError:
+        raise ValueError("Unknown data file format: " + fmt)
+
+
+def exportText(h5Path:str, datPath:str=None) -> str:
+    # Export a HDF5 data file to the tab separated text format, returns the path of the text file
+    if h5py is None:
+        raise ImportError("h5py is needed to read HDF5 data files")
+    if datPath is None:
+        datPath = h5Path.rsplit(".", 1)[0] + ".dat"
+
+    with h5py.File(h5Path, "r") as f:
+        group = f["data"]
+        columns = [str(column) for column in group.attrs["columns"]]
+        data = [group[column][()] for column in columns]
+
+    with TextWriter(datPath, columns) as writer:
+        for values in zip(*data):
+            writer.write(values)
+    return datPath
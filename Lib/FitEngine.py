@@ -0,0 +1,104 @@
+import math
+import threading
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from lmfit import Parameters
+
+try:
+    from Lib.func_gen import Fit_Models
+except ModuleNotFoundError:
+    from func_gen import Fit_Models
+
+models = None  # Fit_Models of a worker process, created with the first chunk
+
+
+def fitChunk(model_names: list, parameter: str, chunk: list) -> list:
+    # Runs in a worker process: fit the spectra of chunk (sorted by angle_or_freq) one after another,
+    # every fit starts from the result of the previous one. parameter: Parameters.dumps() of the first start values
+    # chunk: list of (spectra_index, field, data), returns list of (spectra_index, Parameters.dumps(), success)
+    global models
+    if models is None:
+        models = Fit_Models()
+    _, model = models.getCompiledModel(model_names)
+    dfun = models.getDfun(model_names)  # Analytic Jacobian if sympy is installed
+    fit_kws = {'Dfun': dfun, 'col_deriv': 1} if dfun is not None else None
+
+    params = Parameters().loads(parameter)
+    results = []
+    for index, field, data in chunk:
+        result = model.fit(data, params, B=field, fit_kws=fit_kws)
+        results.append((index, result.params.dumps(), result.success))
+        if result.success:
+            params = result.params
+    return results
+
+
+class FitEngine:
+    # Fits all Spectra of a Measurement that have model names and are not dropped, spread over a process pool
+    # Spectra are sorted by angle_or_freq and split into chunks of neighbours with the same models; within a chunk
+    # each fit is warm started with the result of its neighbour, the first one with its fitted predecessor if any
+    # Results are written back into the Spectra (parameter, fitted) as the chunks finish
+    def __init__(self, measurement, workers: int = None, chunk_size: int = 8, channel: str = 'y_data'):
+        self.measurement = measurement
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.channel = channel  # Spectra array that is fitted against field_data
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        # Can be called from another thread, chunks that did not start yet are dropped
+        self.cancelled.set()
+
+    def chunks(self) -> list:
+        chunks = []
+        current = []
+        for spec in self.measurement.between(-math.inf, math.inf):
+            if spec.model_names is None or spec.dropped:
+                continue
+            if current and (spec.model_names != current[-1].model_names or len(current) >= self.chunk_size):
+                chunks.append(current)
+                current = []
+            current.append(spec)
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def run(self, progress=None) -> int:
+        # progress(done, total) is called after every finished chunk, returns the number of successful fits
+        self.cancelled.clear()
+        chunks = self.chunks()
+        total = sum(len(chunk) for chunk in chunks)
+        done = 0
+        fitted = 0
+
+        with ProcessPoolExecutor(self.workers) as executor:
+            futures = []
+            previous = None
+            for chunk in chunks:
+                start = chunk[0]
+                if previous is not None and previous.fitted and previous.model_names == start.model_names:
+                    start = previous
+                data = [(spec.spectra_index, np.array(spec.field_data, dtype=float),
+                         np.array(getattr(spec, self.channel), dtype=float)) for spec in chunk]
+                futures.append(executor.submit(fitChunk, chunk[0].model_names, start.parameter.dumps(), data))
+                previous = chunk[-1]
+
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                for index, parameter, success in future.result():
+                    spec = self.measurement.get(index)
+                    spec.parameter.loads(parameter)
+                    spec.fitted = success
+                    fitted += success
+                    done += 1
+                if progress is not None:
+                    progress(done, total)
+
+                if self.cancelled.is_set():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+
+        return fitted
@@ -2,16 +2,205 @@ import numpy as np
 import math
 import pyvisa
 import time
+import json
+import os
+import threading
+
+try:
+    from Lib.devices import RotationStage, SimulatedRotationStage
+except ModuleNotFoundError:
+    from devices import RotationStage, SimulatedRotationStage
 
 from PyQt5.QtCore import QThread, pyqtSignal, QObject
 from statistics import mean
+from concurrent.futures import ThreadPoolExecutor
+
+# Worker for instrument queries that can run next to the measurement thread, shared by all measurements
+readPool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="readout")
+
+
+def readPoint(TeslaMeter, LockIn, since:float=None) -> tuple:
+    # Hall sensor (GPIB) and Lock-In (Zurich data server) are independent instruments,
+    # query them concurrently so a point only costs the slower of both
+    # since: host time of the field step, a Hall value sampled after it is used right away
+    fieldFuture = readPool.submit(TeslaMeter.getField, since)
+    data = LockIn.getData()
+    return fieldFuture.result(), data
+
+
+class MeasurementStopped(Exception):
+    # Raised inside a measurement thread after stop() was called, the run ends through shutDown
+    pass
+
+
+class SettleDetector:
+    # Replaces the fixed 7*TC wait after every field step
+    # A low pass of order n answers a step D with D * (1 - r(t)), r(t) = exp(-t/TC) * sum_k<n (t/TC)^k / k!,
+    # so from the reading taken at the field step the part of the step still missing can be estimated.
+    # After the minimum wait (order * TC) the lock-in is read once per TC, the point is considered settled as soon
+    # as that estimate is below the noise floor and X and Y changed less than tolerance * noise floor between
+    # two readings. maxTime [s] is the upper bound, after which the point is taken regardless (old 7*TC behaviour)
+    def __init__(self, LockIn, TC:float, maxTime:float, tolerance:float=3.0, minTime:float=None, order:int=None,
+                 stopEvent:threading.Event=None):
+        self.LockIn = LockIn
+        self.stopEvent = threading.Event() if stopEvent is None else stopEvent # Set: wait returns right away
+        self.TC = TC
+        self.order = getattr(LockIn, "filterOrder", 4) if order is None else order # 4: steepest usual slope
+        self.minTime = self.order * TC if minTime is None else minTime
+        self.maxTime = max(maxTime, self.minTime)
+        self.tolerance = tolerance
+        self.noise = 0.0 # Without a noise floor every point waits maxTime
+        self.lastSettleTime = None
+
+    def setNoiseFloor(self, samples:list):
+        # samples: lock-in readings taken at constant field, e.g. during the phase zeroing
+        # Noise is averaged over X and Y, so it does not depend on the phase shift set afterwards
+        x = np.array([float(sample["x"]) for sample in samples])
+        y = np.array([float(sample["y"]) for sample in samples])
+        self.noise = math.sqrt((np.var(x) + np.var(y)) / 2)
+
+    def remaining(self, elapsed:float) -> float:
+        # Fraction of a step not yet seen at the filter output elapsed s after the step
+        t = elapsed / self.TC
+        return math.exp(-t) * sum(t ** k / math.factorial(k) for k in range(self.order))
+
+    def isSettled(self, first:dict, last:dict, data:dict, elapsed:float) -> bool:
+        # first: reading at the field step, last and data: the two newest readings, data taken elapsed s after the step
+        if self.noise <= 0.0:
+            return False
+        rest = self.remaining(elapsed)
+        for key in ("x", "y"):
+            value = float(data[key])
+            if abs(value - float(last[key])) > self.tolerance * self.noise:
+                return False
+            if abs(value - float(first[key])) * rest / (1 - rest) > self.noise:
+                return False
+        return True
+
+    def wait(self) -> float:
+        # Blocks until the lock-in signal is settled, returns the used settle time in s
+        start = time.perf_counter()
+        first = self.LockIn.getData() # Filter output has not moved yet, value before the step
+        self.stopEvent.wait(self.minTime)
+        last = self.LockIn.getData()
+        while not self.stopEvent.is_set():
+            remaining = self.maxTime - (time.perf_counter() - start)
+            if remaining <= 0:
+                break
+            self.stopEvent.wait(min(self.TC, remaining))
+            data = self.LockIn.getData()
+            if self.isSettled(first, last, data, time.perf_counter() - start):
+                break
+            last = data
+
+        self.lastSettleTime = time.perf_counter() - start
+        return self.lastSettleTime
+
+
+class Checkpoint:
+    # Progress of a running measurement as JSON file next to the data file
+    # Holds the infos needed to restart the thread plus angle/frequency/field index and the phase offset,
+    # so an interrupted run can be resumed and appended to the same data file.
+    # The measurement threads only attach the indices to their points as dataOut["progress"], the
+    # BufferedWriter calls update after those points are flushed and finish once the measurement completed.
+    # Without infos["checkpoint"] (e.g. for modes that cannot be resumed) update and finish do nothing
+    def __init__(self, infos:dict):
+        self.path = infos.get("checkpoint")
+        saved = {key: val for key, val in infos.items() if key not in ("calibration", "resume")}
+        self.state = {"infos": saved, "angleIndex": 0, "freqIndex": 0, "fieldIndex": -1, "phase": None}
+
+    def update(self, angleIndex:int=0, freqIndex:int=0, fieldIndex:int=0, phase:float=None):
+        if self.path is None:
+            return
+        self.state.update({"angleIndex": angleIndex, "freqIndex": freqIndex, "fieldIndex": fieldIndex, "phase": phase})
+
+        # Write to temporary file first, so a crash while writing can not destroy the last checkpoint
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f, default=lambda obj: obj.tolist() if hasattr(obj, "tolist") else str(obj))
+        os.replace(self.path + ".tmp", self.path)
+
+    def finish(self):
+        # Measurement completed, nothing left to resume
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def load(path:str) -> dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def resumeIndices(infos:dict) -> tuple:
+        # First angle, frequency and field index still to measure; (0, 0, 0) for a fresh run
+        resume = infos.get("resume")
+        if resume is None:
+            return 0, 0, 0
+        return resume["angleIndex"], resume["freqIndex"], resume["fieldIndex"] + 1
+
+
+class RunningStats:
+    # Running mean and variance (Welford) per field point, rows are field points and columns channels
+    def __init__(self, points:int, channels:int):
+        self.n = np.zeros(points)
+        self.mean = np.zeros((points, channels))
+        self.M2 = np.zeros((points, channels))
+
+    def add(self, index:int, values):
+        values = np.asarray(values, dtype=float)
+        self.n[index] += 1
+        delta = values - self.mean[index]
+        self.mean[index] += delta / self.n[index]
+        self.M2[index] += delta * (values - self.mean[index])
+
+    def variance(self) -> np.ndarray:
+        # Sample variance, NaN for points with less than two passes
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n[:, None] > 1, self.M2 / (self.n[:, None] - 1), np.nan)
+
+    def snr(self, channels=(1, 2)) -> float:
+        # Peak to peak of the averaged signal over the mean standard error of the mean
+        signal = max(np.ptp(self.mean[:, channel]) for channel in channels)
+        noise = math.sqrt(np.nanmean(self.variance()[:, list(channels)] / self.n[:, None]))
+        if noise == 0:
+            return np.inf
+        return signal / noise
+
+
+def binToGrid(grid:np.ndarray, field:np.ndarray, *channels:np.ndarray):
+    # Bins samples taken at arbitrary fields onto the (sorted up or down) field grid
+    # Bin edges are the midpoints between grid points, the outer bins are as wide as their neighbours
+    # Returns mean field, mean of every channel and number of samples per grid point (empty bins are NaN)
+    order = np.argsort(grid)
+    sortedGrid = grid[order]
+    edges = (sortedGrid[1:] + sortedGrid[:-1]) / 2
+    if sortedGrid.shape[0] > 1:
+        first = sortedGrid[0] - (edges[0] - sortedGrid[0])
+        last = sortedGrid[-1] + (sortedGrid[-1] - edges[-1])
+    else:
+        first, last = -np.inf, np.inf
+
+    valid = (field >= first) & (field < last)
+    index = np.digitize(field[valid], edges)
+    counts = np.bincount(index, minlength=grid.shape[0])
+
+    def binMean(values):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.bincount(index, weights=values[valid], minlength=grid.shape[0]) / counts
+        out = np.empty_like(means)
+        out[order] = means
+        return out
+
+    binnedCounts = np.empty_like(counts)
+    binnedCounts[order] = counts
+    return binMean(field), [binMean(channel) for channel in channels], binnedCounts
 
 
 class SweepMeasurement(QThread):
     dataOutSig = pyqtSignal(dict)
+    previewSig = pyqtSignal(dict) # Points only for live plotting, not for the data file
+    passDoneSig = pyqtSignal()
     fieldMoveSig = pyqtSignal(float)
     changeParasSig = pyqtSignal(dict)
-    meterUsageSig = pyqtSignal(bool)
     errorSig = pyqtSignal(str)
     startSig = pyqtSignal()
     doneSig = pyqtSignal()
@@ -21,6 +210,8 @@ class SweepMeasurement(QThread):
         super(SweepMeasurement, self).__init__()
         
         self.pause = False
+        self.stopEvent = threading.Event() # Cooperative stop, see stop()
+        self.fieldStepTime = None # Host time of the last field change, see HallService.getField
 
         self.changeParasSig.connect(self.setUpParas)
 
@@ -31,39 +222,122 @@ class SweepMeasurement(QThread):
         self.LockIn = LockIn
         self.FreqGen = FreqGen
 
-        if self.sweepDirection == "up":
+        if self.sweepDirection in ("up", "serpentine"): # Serpentine only alternates between spectra
             self.sweepRange = np.arange(self.range[0], self.range[1], self.stepSize)
         elif self.sweepDirection == "down":
             self.sweepRange = np.arange(self.range[1], self.range[0], -self.stepSize)
         #print(self.range, self.sweepRange, self.stepSize)
         #self.setFieldSafe(self.sweepRange[0]/1000) # Safely move field to start val
 
-    def run(self):
-        def setFieldSafe(val):
-            print("Setting field save!")
-            # drive the field to value according to maxFieldSpeed
-            # First get current field value and determine the distance to the next field step "val"
-            # if distance bigger than maximum field rate (default: 100 mT/s) safely change the field according to field rate
-            self.meterUsageSig.emit(True)
-
-            self.field = self.TeslaM.getField()  # Read field value
-
-            self.meterUsageSig.emit(False)
-
-            # Amount of steps needed to safely reach desired field val; math.ceil() rounds up to smallest bigger integer
-            steps = math.ceil(abs(self.field - val) / self.maxFieldSpeed)
-            print("Number ov steps", steps)
+    def setFieldSafe(self, val):
+        print("Setting field save!")
+        # drive the field to value according to maxFieldSpeed
+        # First get current field value and determine the distance to the next field step "val"
+        # if distance bigger than maximum field rate (default: 100 mT/s) safely change the field according to field rate
+        self.field = self.TeslaM.getField(self.fieldStepTime)  # Read field value
+
+        # The magnet ramps with maxFieldSpeed [mT/s], hardware timed if the RedLab supports it
+        self.fieldMoveSig.emit(val / 1000)
+        self.Magnet.rampField(self.field, val, self.maxFieldSpeed)
+        self.fieldStepTime = time.perf_counter()
+
+    def startDevices(self, phase:float=None) -> SettleDetector:
+        # Set up Lock-In and frequency generator, zero the phase and return the settle detector for this run
+        # A given phase (resumed run) is set directly instead of zeroing it again
+        self.LockIn.TC = self.TC
+        self.LockIn.modFreq = self.ModFreq
+        self.LockIn.modAmp = self.ModAmp
+        self.LockIn.outputOn()
+
+        self.FreqGen.configure(self.MWFreq, self.MWPow, True, useUmschalter=True)
+
+        # Set phase to Zero, will set Phase and Y-channel to zero
+        self.LockIn.phaseShift = 0 if phase is None else phase
+        phaseList = []
+        sampleList = []
+
+        for _ in np.linspace(0, 7*self.TC, num=7):
+            sample = self.LockIn.getData()
+            phaseList.append(float(sample["phase"]))
+            sampleList.append(sample)
+            time.sleep(self.TC)
+
+        if phase is None:
+            phase = mean(phaseList)
+            self.LockIn.phaseShift = phase
+        self.phase = phase
+
+        settle = SettleDetector(self.LockIn, self.TC, self.maxSettle * self.TC, self.settleTol, stopEvent=self.stopEvent)
+        settle.setNoiseFloor(sampleList)
+        return settle
+
+    def measurePoint(self, fieldStep:float, settle:SettleDetector) -> dict:
+        # Step the field to fieldStep [mT], wait until settled and read Hall sensor and Lock-In
+        self.waitPaused()
+        self.Magnet.setField(fieldStep/1000)
+        self.fieldStepTime = time.perf_counter()
+        self.fieldMoveSig.emit(fieldStep/1000)
+        settleTime = settle.wait()
+        self.checkStop()
+        print(f"Field {fieldStep} mT settled after {settleTime:.3f} s")
+        field, data = readPoint(self.TeslaM, self.LockIn, self.fieldStepTime)
+
+        return {"data": data, "field": field, "settleTime": settleTime}
+
+    def stop(self):
+        # Called from the GUI instead of terminate(): the thread leaves its loop at the next point or settle check
+        # and ramps the field down itself, so no lock shared with the GUI (Hall service, Lock-In) is left held
+        self.stopEvent.set()
+        self.pause = False
 
-            for fieldStep in np.linspace(self.field, val, num=10*steps+1):
-                self.fieldMoveSig.emit(fieldStep / 1000)
-                self.Magnet.setField(fieldStep / 1000)
-                print("Set field to:", fieldStep)
-                time.sleep(0.1)
+    def checkStop(self):
+        if self.stopEvent.is_set():
+            raise MeasurementStopped()
+
+    def waitPaused(self):
+        while self.pause and not self.stopEvent.is_set():
+            time.sleep(0.2)
+        self.checkStop()
+
+    def shutDown(self):
+        # Outputs off and field back to zero after a stopped run
+        print("Measurement stopped")
+        self.LockIn.outputOff()
+        self.FreqGen.outputOff()
+        self.setFieldSafe(0.0)
+
+    def averagePasses(self, settle:SettleDetector):
+        # Repeat the sweep up to avrg times, keeping running mean and variance of field, X and Y per point
+        # Stops as soon as the averaged sweep reaches targetSNR, weak samples therefore get more passes
+        stats = RunningStats(self.sweepRange.shape[0], 3)
+        for sweepPass in range(self.avrg):
+            if sweepPass > 0:
+                self.setFieldSafe(self.sweepRange[0])
+                self.passDoneSig.emit()
+            for index, fieldStep in enumerate(self.sweepRange):
+                dataOut = self.measurePoint(fieldStep, settle)
+                stats.add(index, (dataOut["field"], float(dataOut["data"]["x"]), float(dataOut["data"]["y"])))
+                self.previewSig.emit(dataOut)
+
+            if sweepPass > 0:
+                snr = stats.snr()
+                print(f"Pass {sweepPass + 1}/{self.avrg}: SNR {snr:.1f}")
+                if self.targetSNR > 0 and snr >= self.targetSNR:
+                    break
+
+        self.passDoneSig.emit()
+        variance = stats.variance()
+        for index in range(self.sweepRange.shape[0]):
+            field, x, y = stats.mean[index]
+            dataOut = {"data": {"x": x, "y": y, "phase": math.atan2(y, x)}, "field": field,
+                       "xVar": variance[index, 1], "yVar": variance[index, 2], "passes": int(stats.n[index])}
+            self.dataOutSig.emit(dataOut)
 
-        setFieldSafe(self.sweepRange[0])  # Safely move field to start val
+    def run(self):
+        _, _, startField = Checkpoint.resumeIndices(self.infos)
+        self.setFieldSafe(self.sweepRange[min(startField, self.sweepRange.shape[0] - 1)])  # Safely move field to start val
         time.sleep(3)
         try:
-            self.meterUsageSig.emit(True)
             self.fieldMoveSig.emit(True)
             # fMin = 100  # Hz
             # fMax = 20000  # Hz
@@ -73,187 +347,404 @@ class SweepMeasurement(QThread):
             #     setFieldSafe(self.sweepRange[0])  # Safely move field to start val
             #     time.sleep(3)
 
-            self.LockIn.TC = self.TC
-            self.LockIn.modFreq = self.ModFreq
-            self.LockIn.modAmp = self.ModAmp
-            self.LockIn.outputOn()
-
-            self.FreqGen.setFreq(self.MWFreq, True)
-            self.FreqGen.setPower(self.MWPow)
-            self.FreqGen.outputOn()
-
-            # Set phase to Zero, will set Phase and Y-channel to zero
-            self.LockIn.daq.setDouble('/dev280/demods/0/phaseshift', 0)
-            phaseList = []
-
-            for _ in np.linspace(0, 7*self.TC, num=7):
-                val = self.LockIn.getTheta()
-                phaseList.append(val)
-                time.sleep(self.TC)
+            settle = self.startDevices(self.infos.get("resume", {}).get("phase"))
 
-            phase = mean(phaseList)
-            self.LockIn.daq.setDouble('/dev280/demods/0/phaseshift', phase)
-
-            dataOut = {}
-            for fieldStep in self.sweepRange:
-                if self.pause:
-                    while self.pause: time.sleep(0.2)
-                self.Magnet.setField(fieldStep/1000)
-                self.fieldMoveSig.emit(fieldStep/1000)
-                time.sleep( 7 * self.TC )
-                field = self.TeslaM.getField()
-                data = self.LockIn.getData()
-
-                dataOut["data"] = data
-                dataOut["field"] = field
-                self.dataOutSig.emit(dataOut)
+            if self.avrg <= 1:
+                for fieldIndex in range(startField, self.sweepRange.shape[0]):
+                    dataOut = self.measurePoint(self.sweepRange[fieldIndex], settle)
+                    dataOut["progress"] = {"fieldIndex": fieldIndex, "phase": self.phase}
+                    self.dataOutSig.emit(dataOut)
+            else:
+                self.averagePasses(settle)
 
             self.LockIn.outputOff()
             self.FreqGen.outputOff()
 
-            setFieldSafe(0.0)
+            self.setFieldSafe(0.0)
+            self.doneSig.emit()
 
             #self.fieldMoveSig.emit(False)
-            self.meterUsageSig.emit(False)
+        except MeasurementStopped:
+            self.shutDown()
         except Exception as e:
             self.errorSig.emit(e)
 
     def setUpParas(self, infos:dict):
+        self.infos = infos
         self.range = infos.get("range")
         self.stepSize = float(infos.get("stepSize"))
         self.TC = float(infos.get("TC"))
         self.ModFreq = float(infos.get("ModFreq"))
         self.ModAmp = float(infos.get("ModAmp"))
         self.avrg = int(infos.get("avrg"))
+        self.targetSNR = float(infos.get("targetSNR", 0)) # Early stop of averaging, 0 runs all passes
         self.maxFieldSpeed = float(infos.get("maxFieldSpeed"))
+        self.maxSettle = float(infos.get("maxSettle", 7)) # Upper bound of settle time in units of TC
+        self.settleTol = float(infos.get("settleTol", 3)) # Settle tolerance in units of the noise floor
         self.calib = infos.get("calibration")
         self.sweepDirection = infos.get("sweepDirection")
         self.MWFreq = float(infos.get("MWFreq"))
         self.MWPow = float(infos.get("MWPow"))
 
-class AngularDependence(SweepMeasurement):
+class RampSweepMeasurement(SweepMeasurement):
+    # Continuous ("on-the-fly") field sweep
+    # Instead of stepping and settling per point, the magnet is ramped at a fixed rate while the Lock-In streams into
+    # its buffer and the Hall service keeps sampling with timestamps. Afterwards the Lock-In samples get their field by
+    # interpolating the Hall history in time and are binned onto sweepRange.
     def __init__(self, MagnetPWR:pyvisa.Resource, TeslaMeter:pyvisa.Resource,
                         FreqGen:pyvisa.Resource, LockIn, infos:dict):
-        super(AngularDependence, self).__init__(MagnetPWR, TeslaMeter, FreqGen, LockIn, infos)
+        super(RampSweepMeasurement, self).__init__(MagnetPWR, TeslaMeter, FreqGen, LockIn, infos)
+        self.rampInterval = 0.05 # s between two magnet updates
 
-class FreqSweepMeasurement(QThread):
-    freqDataOutSig = pyqtSignal(dict)
-    fieldMoveSig = pyqtSignal(float)
-    freqSweepDoneSig = pyqtSignal()
-    changeParasSig = pyqtSignal(dict)
-    meterUsageSig = pyqtSignal(bool)
-    errorSig = pyqtSignal(str)
-
-    def __init__(self, MagnetPWR, TeslaMeter, LockIn, FreqGen, infos):
-        super(FreqSweepMeasurement, self).__init__()
-
-        self.pause = False
+    def setUpParas(self, infos:dict):
+        super(RampSweepMeasurement, self).setUpParas(infos)
+        # Ramp rate in mT/s, 0 lets the rate follow from step size and TC: one step per 2 TC
+        self.rampRate = float(infos.get("rampRate", 0))
+        # Delay of the Lock-In output behind the field in units of TC (group delay of the 3rd order low pass)
+        self.rampLag = float(infos.get("rampLag", 3))
 
-        self.changeParasSig.connect(self.setUpParas)
+    def run(self):
+        rate = self.rampRate
+        if rate <= 0:
+            rate = self.stepSize / (2 * self.TC)
+        rate = min(rate, self.maxFieldSpeed)
+
+        # Start and stop one step outside the grid, so the outer bins are completely covered
+        sign = 1.0 if self.sweepRange[-1] >= self.sweepRange[0] else -1.0
+        start = self.sweepRange[0] - sign * self.stepSize
+        stop = self.sweepRange[-1] + sign * self.stepSize
+        duration = abs(stop - start) / rate
+        print(f"Ramping {start} -> {stop} mT at {rate:.3f} mT/s, expected duration {duration:.1f} s")
+
+        self.setFieldSafe(start)  # Safely move field to start val
+        time.sleep(3)
+        # The Zurich streams all the time, the SR830 only records into its buffer while a stream is started
+        ownStream = not getattr(self.LockIn, "streaming", True)
+        try:
+            self.startDevices()
+            if ownStream:
+                self.LockIn.startStream(duration=duration + self.rampLag * self.TC + 10)
+
+            hallBlocks = []
+            blocks = []
+
+            startTime = time.perf_counter()
+            lastSample = startTime
+            lastHall = startTime
+            elapsed = 0.0
+            while elapsed < duration:
+                loopStart = time.perf_counter()
+                if self.pause:
+                    self.waitPaused()
+                    startTime += time.perf_counter() - loopStart
+                self.checkStop()
+
+                target = start + sign * rate * elapsed
+                self.Magnet.setField(target / 1000)
+                self.fieldMoveSig.emit(target / 1000)
+
+                # Drain the Lock-In buffer and the Hall history regularly, both only hold the last minute of samples
+                block = self.LockIn.getStream(lastSample)
+                if block.shape[0] > 0:
+                    blocks.append(block)
+                    lastSample = np.nextafter(block[-1, 0], np.inf)
+                hall = self.TeslaM.getHistory(lastHall)
+                if hall.shape[0] > 0:
+                    hallBlocks.append(hall)
+                    lastHall = np.nextafter(hall[-1, 0], np.inf)
+
+                time.sleep(max(0.0, self.rampInterval - (time.perf_counter() - loopStart)))
+                elapsed = time.perf_counter() - startTime
+
+            self.Magnet.setField(stop / 1000)
+            time.sleep(self.rampLag * self.TC)
+            blocks.append(self.LockIn.getStream(lastSample))
+            hallBlocks.append(self.TeslaM.getHistory(lastHall))
+            self.LockIn.outputOff()
+            self.FreqGen.outputOff()
 
-        self.setUpParas(infos)
+            stream = np.concatenate(blocks)
+            if stream.shape[0] == 0:
+                raise RuntimeError("No Lock-In samples were recorded during the ramp")
+            hall = np.concatenate(hallBlocks)
+            if hall.shape[0] == 0:
+                raise RuntimeError("No Hall sensor values were recorded during the ramp, is the Hall service running?")
+            # The Lock-In output at time t reflects the field at t - lag
+            sampleField = np.interp(stream[:, 0] - self.rampLag * self.TC, hall[:, 0], hall[:, 1])
+            binField, (x, y), counts = binToGrid(self.sweepRange, sampleField, stream[:, 1], stream[:, 2])
+            print(f"Binned {stream.shape[0]} samples, {np.sum(counts == 0)} of {counts.shape[0]} points empty")
+
+            for index in range(self.sweepRange.shape[0]):
+                if counts[index] == 0:
+                    continue
+                dataOut = {"data": {"x": x[index], "y": y[index], "phase": math.atan2(y[index], x[index])},
+                           "field": binField[index]}
+                self.dataOutSig.emit(dataOut)
 
-        self.Magnet = MagnetPWR
-        self.TeslaM = TeslaMeter
-        self.LockIn = LockIn
-        self.FreqGen = FreqGen
+            self.setFieldSafe(0.0)
+            self.doneSig.emit()
+        except MeasurementStopped:
+            self.shutDown()
+        except Exception as e:
+            self.errorSig.emit(e)
+        finally:
+            if ownStream:
+                self.LockIn.stopStream()
+
+class AdaptiveSweepMeasurement(SweepMeasurement):
+    # Field sweep with a non-uniform grid
+    # A coarse pass (coarseFactor * stepSize) is measured first, the coarse intervals where X/Y show a large
+    # derivative or curvature are then filled with points of stepSize, the most structured intervals first,
+    # until pointBudget is used up. The merged grid is emitted in sweep order via dataOutSig,
+    # coarse pass points are only sent to previewSig for live plotting.
+    def setUpParas(self, infos:dict):
+        super(AdaptiveSweepMeasurement, self).setUpParas(infos)
+        self.coarseFactor = int(infos.get("coarseFactor", 5))
+        # Total number of points (coarse + fine), default is half of the uniform sweep
+        uniformPoints = math.ceil(abs(self.range[1] - self.range[0]) / self.stepSize)
+        self.pointBudget = int(infos.get("pointBudget", uniformPoints // 2))
+        self.refineThreshold = float(infos.get("refineThreshold", 5)) # Interval score in units of the noise floor
+
+    def refinementGrid(self, coarseField:np.ndarray, x:np.ndarray, y:np.ndarray, noise:float) -> np.ndarray:
+        # Returns the fine field points for the structured coarse intervals, limited by the point budget
+        if coarseField.shape[0] < 3:
+            return np.array([])
+
+        score = np.zeros(coarseField.shape[0])
+        for channel in (x, y):
+            diff = np.abs(np.gradient(channel)) # Change per coarse step
+            curv = np.abs(np.gradient(np.gradient(channel))) # Change of change per coarse step
+            score += diff + curv
+
+        intervalScore = np.maximum(score[:-1], score[1:])
+        if noise > 0:
+            threshold = self.refineThreshold * noise
+        else:
+            threshold = np.median(intervalScore) # Without noise floor, refine the above average intervals
+
+        sign = 1.0 if coarseField[-1] >= coarseField[0] else -1.0
+        budget = self.pointBudget - coarseField.shape[0]
+        fine = []
+        for index in np.argsort(intervalScore)[::-1]:
+            if intervalScore[index] <= threshold or budget <= 0:
+                break
+            points = np.arange(coarseField[index], coarseField[index + 1], sign * self.stepSize)[1:]
+            points = points[sign * (coarseField[index + 1] - points) > self.stepSize / 2][:budget]
+            fine.append(points)
+            budget -= points.shape[0]
+
+        if not fine:
+            return np.array([])
+        fine = np.sort(np.concatenate(fine))
+        return fine[::-1] if sign < 0 else fine
 
-        if self.sweepDirection == "up":
-            self.sweepRange = np.arange(self.range[0], self.range[1], self.stepSize)
-        elif self.sweepDirection == "down":
-            self.sweepRange = np.arange(self.range[1], self.range[0], -self.stepSize)
-        # print(self.range, self.sweepRange, self.stepSize)
-        # self.setFieldSafe(self.sweepRange[0]/1000) # Safely move field to start val
+    def run(self):
+        sign = 1.0 if self.sweepRange[-1] >= self.sweepRange[0] else -1.0
+        coarseGrid = np.arange(self.sweepRange[0], self.sweepRange[-1] + sign * self.stepSize,
+                               sign * self.coarseFactor * self.stepSize)
 
-    def setUpParas(self, infos:dict):
-        self.range = infos.get("range")
-        self.stepSize = float(infos.get("stepSize"))
-        self.TC = float(infos.get("TC"))
-        self.ModFreq = float(infos.get("ModFreq"))
-        self.ModAmp = float(infos.get("ModAmp"))
-        self.avrg = int(infos.get("avrg"))
-        self.maxFieldSpeed = float(infos.get("maxFieldSpeed"))
-        self.calib = infos.get("calibration")
-        self.sweepDirection = infos.get("sweepDirection")
-        self.fSweepRange = infos.get("FreqSweep")
+        self.setFieldSafe(coarseGrid[0])  # Safely move field to start val
+        time.sleep(3)
+        try:
+            settle = self.startDevices()
+
+            points = []
+            for fieldStep in coarseGrid:
+                dataOut = self.measurePoint(fieldStep, settle)
+                points.append((fieldStep, dataOut))
+                self.previewSig.emit(dataOut)
+
+            x = np.array([float(dataOut["data"]["x"]) for _, dataOut in points])
+            y = np.array([float(dataOut["data"]["y"]) for _, dataOut in points])
+            fineGrid = self.refinementGrid(coarseGrid, x, y, settle.noise)
+            print(f"Coarse pass: {coarseGrid.shape[0]} points, refining with {fineGrid.shape[0]} points")
+
+            if fineGrid.shape[0] > 0:
+                self.setFieldSafe(fineGrid[0])
+            lastStep = fineGrid[0] if fineGrid.shape[0] > 0 else None
+            for fieldStep in fineGrid:
+                if abs(fieldStep - lastStep) > self.coarseFactor * self.stepSize:
+                    self.setFieldSafe(fieldStep) # Jump over a not refined region
+                dataOut = self.measurePoint(fieldStep, settle)
+                points.append((fieldStep, dataOut))
+                self.previewSig.emit(dataOut)
+                lastStep = fieldStep
 
-    def run(self) -> None:
-        def setFieldSafe(val):
-            print("Setting field save!")
-            # drive the field to value according to maxFieldSpeed
-            # First get current field value and determine the distance to the next field step "val"
-            # if distance bigger than maximum field rate (default: 100 mT/s) safely change the field according to field rate
-            self.meterUsageSig.emit(True)
+            self.LockIn.outputOff()
+            self.FreqGen.outputOff()
 
-            self.field = self.TeslaM.getField()  # Read field value
+            self.passDoneSig.emit()
+            points.sort(key=lambda point: sign * point[0])
+            for _, dataOut in points:
+                self.dataOutSig.emit(dataOut)
 
-            self.meterUsageSig.emit(False)
+            self.setFieldSafe(0.0)
+            self.doneSig.emit()
+        except MeasurementStopped:
+            self.shutDown()
+        except Exception as e:
+            self.errorSig.emit(e)
 
-            # Amount of steps needed to safely reach desired field val; math.ceil() rounds up to smallest bigger integer
-            steps = math.ceil(abs(self.field - val) / self.maxFieldSpeed)
-            print("Number ov steps", steps)
+class AngularDependence(SweepMeasurement):
+    # Field sweeps over the list of sample angles, optionally for every frequency in infos["FreqSweep"]
+    # All spectra go through angDataOutSig tagged with angle, frequency and power, so they end up in one file.
+    # After the last spectrum of an angle the stage already rotates to the next angle while the magnet ramps back.
+    angDataOutSig = pyqtSignal(dict)
+    angleDoneSig = pyqtSignal()
 
-            for fieldStep in np.linspace(self.field, val, num=10 * steps + 1):
-                self.fieldMoveSig.emit(fieldStep / 1000)
-                self.Magnet.setField(fieldStep / 1000)
-                print("Set field to:", fieldStep)
-                time.sleep(0.1)
+    def __init__(self, MagnetPWR:pyvisa.Resource, TeslaMeter:pyvisa.Resource,
+                        FreqGen:pyvisa.Resource, LockIn, infos:dict, Stage:RotationStage=None):
+        super(AngularDependence, self).__init__(MagnetPWR, TeslaMeter, FreqGen, LockIn, infos)
+        self.Stage = Stage if Stage is not None else SimulatedRotationStage()
 
-        setFieldSafe(self.sweepRange[0])  # Safely move field to start val
-        time.sleep(5) # Settling time of the magnet
+    def setUpParas(self, infos:dict):
+        super(AngularDependence, self).setUpParas(infos)
+        self.angles = np.atleast_1d(np.asarray(infos.get("angles", [0.0]), dtype=float))
+        self.fSweepRange = infos.get("FreqSweep", [])
 
+    def run(self):
+        if len(self.fSweepRange) > 0:
+            frequencies = [(float(freq), float(pow)) for freq, pow in self.fSweepRange]
+        else:
+            frequencies = [(self.MWFreq, self.MWPow)]
+
+        startAngle, startFreq, startField = Checkpoint.resumeIndices(self.infos)
+        self.Stage.moveTo(self.angles[startAngle])
+        self.setFieldSafe(self.sweepRange[min(startField, self.sweepRange.shape[0] - 1)])  # Safely move field to start val
+        self.Stage.waitMoved()
+        time.sleep(3)
         try:
-            self.meterUsageSig.emit(True)
-            # self.fieldMoveSig.emit(True)
+            settle = self.startDevices(self.infos.get("resume", {}).get("phase"))
+
+            for angleIndex, angle in enumerate(self.angles):
+                for freqIndex, (freq, pow) in enumerate(frequencies):
+                    if (angleIndex, freqIndex) < (startAngle, startFreq):
+                        continue # Already measured before the run was interrupted
+                    fieldStart = startField if (angleIndex, freqIndex) == (startAngle, startFreq) else 0
+
+                    if len(self.fSweepRange) > 0: # Frequency list given, also a list with a single entry
+                        self.FreqGen.configure(freq, pow, useUmschalter=True)
+
+                    for fieldIndex in range(fieldStart, self.sweepRange.shape[0]):
+                        dataOut = self.measurePoint(self.sweepRange[fieldIndex], settle)
+                        dataOut["angle"] = angle
+                        dataOut["freq"] = freq
+                        dataOut["pow"] = pow
+                        dataOut["progress"] = {"angleIndex": angleIndex, "freqIndex": freqIndex,
+                                               "fieldIndex": fieldIndex, "phase": self.phase}
+                        self.angDataOutSig.emit(dataOut)
+                    self.angleDoneSig.emit()
+
+                    if freqIndex == len(frequencies) - 1 and angleIndex == len(self.angles) - 1:
+                        break # Last spectrum, no need to ramp back
+                    if freqIndex == len(frequencies) - 1:
+                        self.Stage.moveTo(self.angles[angleIndex + 1]) # Rotate while the magnet ramps back
+                    self.setFieldSafe(self.sweepRange[0])
+                    self.Stage.waitMoved()
+
+            self.LockIn.outputOff()
+            self.FreqGen.outputOff()
 
-            self.LockIn.TC = self.TC
-            self.LockIn.modFreq = self.ModFreq
-            self.LockIn.modAmp = self.ModAmp
-            self.LockIn.outputOn()
+            self.setFieldSafe(0.0)
+            self.doneSig.emit()
+        except MeasurementStopped:
+            self.shutDown()
+        except Exception as e:
+            self.errorSig.emit(e)
 
-            self.FreqGen.outputOn()
+class FreqSweepMeasurement(SweepMeasurement):
+    # Field sweeps for every (frequency, power) in infos["FreqSweep"], settle detection and readout as in SweepMeasurement
+    # Serpentine: every second frequency is swept backwards, so the magnet does not jump back to the start
+    freqDataOutSig = pyqtSignal(dict)
+    freqSweepDoneSig = pyqtSignal()
 
+    def __init__(self, MagnetPWR, TeslaMeter, LockIn, FreqGen, infos):
+        super(FreqSweepMeasurement, self).__init__(MagnetPWR, TeslaMeter, FreqGen, LockIn, infos)
+        self.serpentine = self.sweepDirection == "serpentine"
 
-            # Set phase to Zero, will set Phase and Y-channel to zero
-            self.LockIn.daq.setDouble('/dev280/demods/0/phaseshift', 0)
-            phaseList = []
+    def setUpParas(self, infos:dict):
+        # infos["MWFreq"] is only a marker here, the generator starts with the first entry of the list
+        self.fSweepRange = infos.get("FreqSweep")
+        freq, pow = self.fSweepRange[0]
+        super(FreqSweepMeasurement, self).setUpParas(dict(infos, MWFreq=freq, MWPow=pow))
+        self.infos = infos
+        self.listMode = bool(infos.get("listMode", False)) # Step the frequencies from the generator's list memory
+        self.listTrigger = infos.get("listTrigger", "bus") # How the list advances, see FreqGenerator.startList
+
+    def shutDown(self):
+        print("Measurement stopped")
+        self.LockIn.outputOff()
+        if self.listMode:
+            self.FreqGen.stopList()
+        self.FreqGen.configure(5.0, 0.0, False)
+        self.setFieldSafe(0.0)
 
-            for _ in np.linspace(0, 7 * self.TC, num=7):
-                val = self.LockIn.getTheta()
-                phaseList.append(val)
-                time.sleep(self.TC)
+    def run(self) -> None:
+        _, startFreq, startField = Checkpoint.resumeIndices(self.infos)
+        backwards = self.serpentine and startFreq % 2 == 1
+        if startField >= self.sweepRange.shape[0]:
+            startFreq, startField = startFreq + 1, 0 # Interrupted right after a complete frequency
+        elif backwards:
+            startField = 0 # Backwards sweeps are only stored once complete, repeat the whole frequency
+        if self.serpentine and startFreq % 2 == 1:
+            self.setFieldSafe(self.sweepRange[-1])
+        else:
+            self.setFieldSafe(self.sweepRange[startField])  # Safely move field to start val
+        time.sleep(5) # Settling time of the magnet
 
-            phase = mean(phaseList)
-            self.LockIn.daq.setDouble('/dev280/demods/0/phaseshift', phase)
-
-            for freq, pow in self.fSweepRange:
-                self.FreqGen.setFreq(freq, True)
-                self.FreqGen.setPower(pow)
-                freqDataOut = {}
-                for fieldStep in self.sweepRange:
-                    if self.pause:
-                        while self.pause: time.sleep(0.2)
-                    self.Magnet.setField(fieldStep / 1000)
-                    self.fieldMoveSig.emit(fieldStep / 1000)
-                    time.sleep(7 * self.TC)
-                    field = self.TeslaM.getField()
-                    data = self.LockIn.getData()
-
-                    freqDataOut["data"] = data
-                    freqDataOut["field"] = field
+        try:
+            # A resumed run keeps its phase
+            settle = self.startDevices(self.infos.get("resume", {}).get("phase"))
+
+            if self.listMode:
+                self.FreqGen.loadList([freq for freq, pow in self.fSweepRange], [pow for freq, pow in self.fSweepRange])
+                self.FreqGen.startList(self.listTrigger)
+
+            for freqIndex, (freq, pow) in enumerate(self.fSweepRange):
+                if freqIndex < startFreq:
+                    continue # Already measured before the run was interrupted
+                if self.listMode:
+                    self.FreqGen.stepList(freqIndex, useUmschalter=True)
+                else:
+                    self.FreqGen.configure(freq, pow, useUmschalter=True)
+
+                backwards = self.serpentine and freqIndex % 2 == 1
+                fieldIndices = range(self.sweepRange.shape[0])
+                if backwards:
+                    fieldIndices = fieldIndices[::-1]
+                elif freqIndex == startFreq:
+                    fieldIndices = fieldIndices[startField:]
+                points = []
+                for fieldIndex in fieldIndices:
+                    freqDataOut = self.measurePoint(self.sweepRange[fieldIndex], settle)
                     freqDataOut["freq"] = freq
                     freqDataOut["pow"] = pow
-                    self.freqDataOutSig.emit(freqDataOut)
+                    if backwards:
+                        points.append(freqDataOut)
+                        self.previewSig.emit(freqDataOut)
+                    else:
+                        freqDataOut["progress"] = {"freqIndex": freqIndex, "fieldIndex": fieldIndex, "phase": self.phase}
+                        self.freqDataOutSig.emit(freqDataOut)
+
+                if backwards:
+                    # Store backwards sweeps in the same field order as the forward ones
+                    # Only the last point carries progress, the frequency counts as done once it is complete
+                    self.passDoneSig.emit()
+                    points[0]["progress"] = {"freqIndex": freqIndex, "fieldIndex": self.sweepRange.shape[0] - 1,
+                                             "phase": self.phase}
+                    for freqDataOut in reversed(points):
+                        self.freqDataOutSig.emit(freqDataOut)
                 self.freqSweepDoneSig.emit()
 
             self.LockIn.outputOff()
-            self.FreqGen.outputOff()
-            self.FreqGen.setFreq(5.0)
-            self.FreqGen.setPower(0.0)
-
-            setFieldSafe(0.0)
-
-            self.meterUsageSig.emit(False)
+            if self.listMode:
+                self.FreqGen.stopList()
+            self.FreqGen.configure(5.0, 0.0, False)
+
+            self.setFieldSafe(0.0)
+            self.doneSig.emit()
+        except MeasurementStopped:
+            self.shutDown()
         except Exception as e:
             self.errorSig.emit(e)
 
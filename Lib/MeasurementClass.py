@@ -1,29 +1,71 @@
+import bisect
 import json
+import math
+import os
+import struct
+import zipfile
 
 import numpy as np
 import pandas as pd
 
 try:
-    from Lib.SpectraClass import Spectra
+    from Lib.SpectraClass import Spectra, ARRAY_FIELDS
+    from Lib.FitEngine import FitEngine
 except ModuleNotFoundError:
-    from SpectraClass import Spectra
+    from SpectraClass import Spectra, ARRAY_FIELDS
+    from FitEngine import FitEngine
 from typing import List, Union
 
 
+# Bruker IRFMT/data format -> numpy type
+BRUKER_FORMATS = {'D': 'f8', 'F': 'f4', 'I': 'i4', 'S': 'i2', 'C': 'i1'}
+# Field unit -> factor to Tesla
+FIELD_UNITS = {'G': 1e-4, 'mT': 1e-3, 'T': 1.0}
+
+
+def mapMember(path: str, archive: zipfile.ZipFile, member: str) -> np.ndarray:
+    # Memory map the .npy member of an uncompressed .npz file, its data is only read from disk where accessed
+    # Compressed or empty members are read normally
+    info = archive.getinfo(member + '.npy')
+    with archive.open(info) as f:
+        version = np.lib.format.read_magic(f)
+        shape, fortran, dtype = (np.lib.format.read_array_header_1_0(f) if version == (1, 0)
+                                 else np.lib.format.read_array_header_2_0(f))
+        headerSize = f.tell()
+        if info.compress_type != zipfile.ZIP_STORED or dtype.hasobject or not np.prod(shape):
+            f.seek(0)
+            return np.lib.format.read_array(f)
+
+    with open(path, 'rb') as f:
+        # Data starts behind the local file header (30 bytes + name + extra field) and the npy header
+        f.seek(info.header_offset + 26)
+        nameLength, extraLength = struct.unpack('<HH', f.read(4))
+    offset = info.header_offset + 30 + nameLength + extraLength + headerSize
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran else 'C')
+
+
 class Measurement(list):
     # Advanced List to store, load, save and maybe modify Spectra objects
     # Callable, by Measurement(int, int, ..) of unspecific amount of int
     # or Measurement([int, int, int, ..]) of list int
-    # __call__ will sort self before spitting out desired spectra
+    # The list is kept sorted by spectra_index, lookups by index go through the dict by_index
+    # and by_angle is a sorted list of (angle_or_freq, spectra_index) for range queries, see between()
 
     def __init__(self, FMR_type='angdep', anisotropy=None, damping=None, g_factor=None, magnetisation=None):
         super(Measurement, self).__init__()
+        self.by_index = dict()
+        self.by_angle = []
+        self.columns = dict()  # Columnar storage, see consolidate()
         self.FMR_type = FMR_type  # Either angdep, or freqdep
         self.anisotropy = anisotropy
         self.damping = damping
         self.g_factor = g_factor
         self.magnetisation = magnetisation
 
+    def fit(self, workers: int = None, progress=None) -> int:
+        # Fit all spectra in parallel, see FitEngine (use it directly to be able to cancel)
+        return FitEngine(self, workers).run(progress)
+
     def loadFitFile(self):
         # Load previously fitted and saved file
         self.clear()
@@ -63,27 +105,158 @@ class Measurement(list):
         # Load new measurement from file
         self.clear()
 
-        if path[-3:] == 'DTA' or path[-3:] == 'par':
-            path = self.convert_bruker_to_ascii(path)
+        if os.path.splitext(path)[1].upper() in ('.DTA', '.DSC', '.PAR', '.SPC'):
+            field, intensity, angles = self.loadBruker(path)
+            self.setColumns(angles, x_data=field, y_data=intensity, field_data=field)
+            return
 
-        row_skip = self.checkHeader(path)
-        df = pd.read_csv(path, names=['index', 'Field [G]', 'Sample Angle [deg]', 'Intensity []']
-                         , skiprows=row_skip, sep='\s+')
+        data = self.loadArray(path)
+        # data has shape (column, spectrum, field step), columns: index, field [T], angle [deg], intensity
+        # Every spectrum is a view into the (memory mapped) array, nothing is copied
+        # The field axis is shared by all Spectra if every sweep used the same field steps
+        field = data[1, 0] if np.all(data[1] == data[1, :1]) else data[1]
+        self.setColumns(data[2, :, 0], x_data=field, y_data=data[3], field_data=field)
 
-        counts = np.unique(df['Field [G]'].to_numpy()).shape[0]
-        # Counts is equivalent to the  number of Magnetic field steps in the measurement e.g. 1024,2048,4096....
-        chunksize = int(df.shape[0] / counts)  # Number of measurements with length counts
+    def setColumns(self, angles: np.ndarray, **columns: np.ndarray):
+        # Create one Spectra per angle from columnar data, keyword = Spectra array field
+        # 2D arrays (spectra, points) give one row view per Spectra, 1D arrays are shared by all Spectra
+        self.clear()
+        for n, angle in enumerate(angles):
+            rows = [columns[name][n] if np.ndim(columns.get(name)) == 2 else columns.get(name) for name in ARRAY_FIELDS]
+            self.add(Spectra(*rows, float(angle), n))
+        self.columns = columns
 
-        FieldData = np.split(np.true_divide(df['Field [G]'].to_numpy(), 10000), chunksize)
-        AmplData = np.split(df['Intensity []'].to_numpy(), chunksize)
-        AngleData = np.split(df['Sample Angle [deg]'].to_numpy(), chunksize)
+    def consolidate(self):
+        # Move the arrays of all Spectra into columnar storage, one 2D array (spectra, points) per field,
+        # the field axis is stored once if it is the same for all Spectra. The Spectra keep row views
+        self.columns = dict()
+        if not len(self):
+            return
+        for name in ARRAY_FIELDS:
+            arrays = [getattr(spec, name) for spec in self]
+            if any(array is None for array in arrays):
+                continue
+            if name == 'field_data' and all(np.array_equal(array, arrays[0]) for array in arrays):
+                self.columns[name] = np.asarray(arrays[0])
+                for spec in self:
+                    spec.field_data = self.columns[name]
+            else:
+                self.columns[name] = np.stack(arrays)
+                for spec, row in zip(self, self.columns[name]):
+                    setattr(spec, name, row)
 
-        for n in range(chunksize):
-            spec = Spectra(FieldData[n], AmplData[n], AngleData[n][0], n)
-            self.add(spec)
+    def column(self, name: str) -> np.ndarray:
+        # Columnar array of a Spectra field (rows in spectra_index order), e.g. for colormaps or
+        # vectorized baseline corrections of the whole measurement
+        if name not in self.columns:
+            self.consolidate()
+        return self.columns[name]
 
-    def convert_bruker_to_ascii(self, path):
-        raise NotImplementedError
+    @classmethod
+    def loadArray(cls, path: str) -> np.ndarray:
+        # Parse the text file once into a binary sidecar (path + '.npy') and memory map it
+        # The sidecar is rebuilt when the text file is newer
+        sidecar = path + '.npy'
+        if not os.path.exists(sidecar) or os.path.getmtime(sidecar) < os.path.getmtime(path):
+            row_skip = cls.checkHeader(path)
+            raw = pd.read_csv(path, header=None, usecols=range(4), skiprows=row_skip, sep='\s+',
+                              dtype=np.float64).to_numpy()
+
+            # Counts is equivalent to the number of Magnetic field steps in the measurement e.g. 1024,2048,4096....
+            # A new spectrum starts where the angle changes for the first time; without an angle change
+            # (e.g. repeated spectra at one angle) the number of distinct field values is used
+            changes = np.flatnonzero(raw[:, 2] != raw[0, 2])
+            counts = changes[0] if changes.shape[0] else 0
+            if not counts or raw.shape[0] % counts:
+                counts = np.unique(raw[:, 1]).shape[0]
+            chunksize = raw.shape[0] // counts  # Number of measurements with length counts
+
+            # Store column wise, so every column of a spectrum is contiguous; field is converted from G to T
+            data = np.ascontiguousarray(raw[:chunksize * counts].T.reshape(4, chunksize, counts))
+            data[1] /= 10000
+            try:
+                np.save(sidecar, data)
+            except OSError as e:
+                # Read only directory or full disk: use the parsed array from memory, no partial sidecar is left
+                print("Could not write " + sidecar + ", loading without memory map:", e)
+                if os.path.exists(sidecar):
+                    os.remove(sidecar)
+                return data
+
+        return np.load(sidecar, mmap_mode='r')
+
+    @staticmethod
+    def brukerFile(base: str, ext: str) -> str:
+        # Bruker software writes upper case extensions, copies from other systems are often lower case
+        for name in (base + ext.upper(), base + ext.lower()):
+            if os.path.exists(name):
+                return name
+        raise FileNotFoundError(base + ext.upper())
+
+    @staticmethod
+    def readBrukerDescriptor(path: str) -> dict:
+        # Key/value pairs of a .DSC (Xepr) or .par (ESP/WinEPR) file, section and comment lines are skipped
+        params = dict()
+        with open(path, 'r', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[0] in '#*.':
+                    continue
+                parts = line.split(None, 1)
+                params[parts[0]] = parts[1].strip('\'" ') if len(parts) > 1 else ''
+        return params
+
+    @classmethod
+    def loadBruker(cls, path: str):
+        # Read a Bruker file without conversion, the intensities are memory mapped in their stored byte order
+        # Returns field [T] (points), intensity (spectra, points) and angle (spectra)
+        base, ext = os.path.splitext(path)
+        if ext.upper() in ('.DTA', '.DSC'):
+            # Xepr: descriptor .DSC, binary .DTA, non equidistant axes in .XGF/.YGF
+            dsc = cls.readBrukerDescriptor(cls.brukerFile(base, '.DSC'))
+            order = '>' if dsc.get('BSEQ', 'BIG') == 'BIG' else '<'
+            dtype = np.dtype(order + BRUKER_FORMATS[dsc.get('IRFMT', 'D').split(',')[0].strip()])
+            xpts = int(dsc['XPTS'])
+            ypts = int(dsc.get('YPTS', 1)) if dsc.get('YTYP', 'NODATA') != 'NODATA' else 1
+
+            data = np.memmap(cls.brukerFile(base, '.DTA'), dtype=dtype, mode='r')
+            if dsc.get('IKKF', 'REAL').split(',')[0].strip() == 'CPLX':
+                intensity = data.reshape(ypts, xpts, 2)[..., 0]  # Real part
+            else:
+                intensity = data.reshape(ypts, xpts)
+
+            axes = []
+            for axis, pts in (('X', xpts), ('Y', ypts)):
+                if dsc.get(axis + 'TYP') == 'IGD':
+                    axisType = np.dtype(order + BRUKER_FORMATS[dsc.get(axis + 'FMT', 'D')])
+                    values = np.fromfile(cls.brukerFile(base, '.' + axis + 'GF'), dtype=axisType)[:pts]
+                elif axis + 'MIN' in dsc:
+                    start = float(dsc[axis + 'MIN'])
+                    values = np.linspace(start, start + float(dsc[axis + 'WID']), pts)
+                else:
+                    values = np.arange(pts, dtype=np.float64)
+                axes.append(values.astype(np.float64))
+            field = axes[0] * FIELD_UNITS.get(dsc.get('XUNI', 'G'), 1e-4)
+            angles = axes[1]
+        else:
+            # ESP/WinEPR: descriptor .par, binary .spc (little endian float in DOS format, big endian int else)
+            par = cls.readBrukerDescriptor(cls.brukerFile(base, '.par'))
+            dtype = np.dtype('<f4') if 'DOS' in par else np.dtype('>i4')
+            xpts = int(par.get('SSX', par.get('RES', par.get('ANZ', 1024))))
+            ypts = int(par.get('SSY', 1))
+
+            intensity = np.memmap(cls.brukerFile(base, '.spc'), dtype=dtype, mode='r')[:xpts * ypts].reshape(ypts, xpts)
+
+            start = float(par.get('XXLB', par.get('GST', 0)))
+            field = np.linspace(start, start + float(par.get('XXWI', par.get('GSI', 0))), xpts)
+            field *= FIELD_UNITS.get(par.get('JUN', 'G'), 1e-4)
+            if 'XYLB' in par:
+                start = float(par['XYLB'])
+                angles = np.linspace(start, start + float(par.get('XYWI', 0)), ypts)
+            else:
+                angles = np.arange(ypts, dtype=np.float64)
+
+        return field, intensity, angles
 
     def dumps(self):
         pre_dict = {'FMR_type': self.FMR_type, 'anisotropy': self.anisotropy, 'damping': self.damping,
@@ -93,37 +266,157 @@ class Measurement(list):
         dict_to_json = pre_dict | spectra_json
         return json.dumps(dict_to_json)
 
+    def save(self, path: str):
+        # Binary file (.npz, uncompressed so load can memory map it), arrays in their native dtype:
+        # equal for all spectra (e.g. the field axis) once as member 'shared/<name>', equally long ones as one
+        # (spectra, points) member 'columns/<name>' in the order of meta['spectra'], the rest per spectrum
+        # as '<spectra_index>/<name>'. Measurement properties, fit parameters and model names as JSON in member 'meta'
+        arrays = dict()
+        spectra_meta = [spectra.meta() for spectra in self]
+        for name in ARRAY_FIELDS:
+            values = [getattr(spectra, name) for spectra in self]
+            if values and all(value is not None for value in values):
+                first = np.asarray(values[0])
+                if all(value is values[0] or np.array_equal(value, first) for value in values[1:]):
+                    arrays['shared/' + name] = first
+                    continue
+                if first.ndim == 1 and all(np.shape(value) == first.shape for value in values):
+                    arrays['columns/' + name] = np.stack(values)
+                    continue
+            for spectra, value in zip(self, values):
+                if value is not None:
+                    arrays['{}/{}'.format(spectra.spectra_index, name)] = np.asarray(value)
+
+        meta = {'FMR_type': self.FMR_type, 'anisotropy': self.anisotropy, 'damping': self.damping,
+                'g-factor': self.g_factor, 'magnetisation': self.magnetisation, 'spectra': spectra_meta}
+        with open(path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+
+    def load(self, path: str, indices: List[int] = None):
+        # Load a file written by save, only the spectra in indices if given
+        # All arrays are memory mapped views into the file, data is only read when a Spectra array is accessed
+        self.clear()
+        with zipfile.ZipFile(path) as archive:
+            members = {name[:-4] for name in archive.namelist()}
+            with archive.open('meta.npy') as f:
+                meta = json.loads(str(np.lib.format.read_array(f)))
+            self.FMR_type = meta['FMR_type']
+            self.anisotropy = meta['anisotropy']
+            self.damping = meta['damping']
+            self.g_factor = meta['g-factor']
+            self.magnetisation = meta['magnetisation']
+
+            shared = {name: mapMember(path, archive, 'shared/' + name) for name in ARRAY_FIELDS
+                      if 'shared/' + name in members}
+            columns = {name: mapMember(path, archive, 'columns/' + name) for name in ARRAY_FIELDS
+                       if 'columns/' + name in members}
+            for row, spectra_meta in enumerate(meta['spectra']):
+                index = spectra_meta['spectra_index']
+                if indices is not None and index not in indices:
+                    continue
+                arrays = dict(shared)
+                arrays.update({name: column[row] for name, column in columns.items()})
+                for name in ARRAY_FIELDS:
+                    if '{}/{}'.format(index, name) in members:
+                        arrays[name] = mapMember(path, archive, '{}/{}'.format(index, name))
+                self.add(Spectra.fromStored(arrays, spectra_meta))
+
     def add(self, spectra: Spectra):
         # Add spectra to existing Measurement object
         index = spectra.spectra_index
         if not self.isIndexed(spectra):
-            self.insert(index, spectra)
+            super().insert(bisect.bisect(self, index, key=lambda spec: spec.spectra_index), spectra)
+            self.columns = dict()
+            self.by_index[index] = spectra
+            bisect.insort(self.by_angle, (spectra.angle_or_freq, index))
         else:
             raise IndexError("Spectra with same Index already in use!\nSpectra:" + str(index))
 
     def append(self, spectra: Spectra) -> None:
         self.add(spectra)
 
+    def insert(self, position, spectra: Spectra) -> None:
+        # Position is given by spectra_index
+        self.add(spectra)
+
+    def get(self, index: int) -> Spectra:
+        # Spectra by spectra_index
+        return self.by_index[index]
+
+    def between(self, lower: float, upper: float) -> List[Spectra]:
+        # All spectra with lower <= angle_or_freq <= upper, sorted by angle_or_freq
+        start = bisect.bisect_left(self.by_angle, (lower, -math.inf))
+        stop = bisect.bisect_right(self.by_angle, (upper, math.inf))
+        return [self.by_index[index] for _, index in self.by_angle[start:stop]]
+
+    def pop(self, position: int = -1) -> Spectra:
+        spectra = super().pop(position)
+        self.columns = dict()
+        del self.by_index[spectra.spectra_index]
+        del self.by_angle[bisect.bisect_left(self.by_angle, (spectra.angle_or_freq, spectra.spectra_index))]
+        return spectra
+
+    def remove(self, spectra: Spectra) -> None:
+        if self.by_index.get(spectra.spectra_index) is not spectra:
+            raise ValueError("Spectra not in Measurement!\nSpectra:" + str(spectra.spectra_index))
+        self.pop(bisect.bisect_left(self, spectra.spectra_index, key=lambda spec: spec.spectra_index))
+
+    def clear(self) -> None:
+        super().clear()
+        self.columns = dict()
+        self.by_index.clear()
+        self.by_angle.clear()
+
     def delete(self, item: Union[Spectra, int]):
         # item:int deletes list index not spectra index!
 
-        if item == type(int):
+        if isinstance(item, int):
             self.pop(item)
         else:
-            for spec in self:
-                if spec == item:
-                    self.remove(spec)
+            self.remove(item)
+
+    def extend(self, spectras) -> None:
+        for spectra in spectras:
+            self.add(spectra)
+
+    def __iadd__(self, other):
+        if isinstance(other, Spectra):
+            self.add(other)
+        else:
+            self.extend(other)
+        return self
+
+    def __setitem__(self, position, spectra):
+        # Replaces the Spectra at the list position(s), the new ones are sorted in by their spectra_index
+        old = self[position] if isinstance(position, slice) else [self[position]]
+        new = list(spectra) if isinstance(position, slice) else [spectra]
+        free = {spec.spectra_index for spec in old}
+        indices = [spec.spectra_index for spec in new]
+        if len(set(indices)) != len(indices) or any(index in self.by_index and index not in free for index in indices):
+            raise IndexError("Spectra with same Index already in use!\nSpectra:" + str(indices))
+        del self[position]
+        self.extend(new)
+
+    def __delitem__(self, position):
+        if isinstance(position, slice):
+            for spectra in self[position]:
+                self.remove(spectra)
+        else:
+            self.pop(position)
+
+    def sort(self, *args, **kwargs):
+        # The list order is the spectra_index order the indexes rely on, use between() for the angle order
+        raise NotImplementedError("Measurement is always sorted by spectra_index")
+
+    def reverse(self):
+        raise NotImplementedError("Measurement is always sorted by spectra_index")
+
+    def __imul__(self, other):
+        raise NotImplementedError("Spectra can only be indexed once")
 
     def isIndexed(self, spectra: Spectra):
         # Look up if spectra with index spectra.spectra_index is already indexed in self
-        # index = spectra.spectra_index
-        try:
-            indexed_spec = self[spectra.spectra_index]
-            if indexed_spec == spectra:
-                return True
-            return False
-        except IndexError:
-            return False
+        return spectra.spectra_index in self.by_index
 
     def __add__(self, other: Spectra):
         if isinstance(other, Spectra):
@@ -140,14 +433,13 @@ class Measurement(list):
 
     def __call__(self, *args, **kwargs) -> List[Spectra]:
         if args:
-            self.sort()
             rtn_stmnt = []
             for arg in args:
                 if isinstance(arg, int):
-                    rtn_stmnt.append(self[arg])
+                    rtn_stmnt.append(self.by_index[arg])
                 elif isinstance(arg, list):
                     for ar in arg:
-                        rtn_stmnt.append(self[ar])
+                        rtn_stmnt.append(self.by_index[ar])
             return rtn_stmnt
         elif kwargs:
             raise NotImplementedError("Kwargs not Implemented")
@@ -7,12 +7,15 @@ from func_gen import *
 
 Fit_Models = Fit_Models()
 
+ARRAY_FIELDS = ('x_data', 'y_data', 'field_data', 'phase_array')
 
-@dataclass(order=True)
+
+@dataclass(order=True, slots=True)
 class Spectra:
     # Todo: Test serialization to json, and implement dump/load functionality if necessary
     # Dataclass to store individual spectra data, for easy access
     # Compiling several spectra into on object is done by the Measurement class
+    # Slots keep single Spectra light, in columnar storage (Measurement.setColumns) the arrays are only views
     sort_index: int = field(init=False, repr=False)
 
     x_data: np.array
@@ -50,16 +53,34 @@ class Spectra:
 
         return json.dumps(dict_to_json, cls=NumpyArrayEncoder)
 
+    def arrays(self) -> dict:
+        # Data arrays in native dtype for binary storage, see Measurement.save
+        return {name: np.asarray(getattr(self, name)) for name in ARRAY_FIELDS if getattr(self, name) is not None}
+
+    def meta(self) -> dict:
+        # Everything except the data arrays, JSON serializable
+        return {'angle_or_freq': float(self.angle_or_freq), 'spectra_index': self.spectra_index,
+                'model_names': self.model_names, 'fitted': self.fitted, 'dropped': self.dropped,
+                'parameter': self.parameter.dumps() if self.parameter is not None else None}
+
+    @classmethod
+    def fromStored(cls, arrays: dict, meta: dict):
+        # Inverse of arrays() and meta(), rebuilds the fit model from the model names
+        spec = cls(*(arrays.get(name) for name in ARRAY_FIELDS), meta['angle_or_freq'], meta['spectra_index'],
+                   meta['fitted'], meta['dropped'])
+        if meta['model_names'] is not None:
+            spec.model_names = meta['model_names']
+            spec.__post_init__()
+            if meta['parameter'] is not None:
+                spec.parameter.loads(meta['parameter'])
+        return spec
+
     def __post_init__(self):
         if not isinstance(self.spectra_index, int):
             raise TypeError("Parameter spectra_index has to be of type int")
 
         if hasattr(self, 'model_names'):
-            model = Fit_Models.getModelFunc(self.model_names, self.spectra_index)
-            exec(model[0], locals())
-
-            self.function_str = model[0]
-            self.model = Model(locals()[model[1]])
+            self.function_str, self.model = Fit_Models.getCompiledModel(self.model_names)
             self.parameter = self.model.make_params()
         else:
             self.function_str = None
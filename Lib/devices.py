@@ -1,5 +1,7 @@
 import pyvisa
 import math
+import ctypes
+import threading
 import numpy as np
 import pandas as pd
 import time
@@ -133,6 +135,43 @@ class RedLab:
     def VOut(self, channel, value):
         ul.v_out(self.boardNum, channel, self.ranges[0], value)
 
+    def VOutScan(self, channel:int, volts:np.ndarray, rate:float) -> bool:
+        # Play volts out on channel as hardware timed analog output scan in the background, rate in S/s
+        # Returns False if the board has no paced analog output, the DAC keeps the last value after the scan
+        if not self.deviceInfo.get_ao_info().supports_scan:
+            return False
+        self.stopScan()
+
+        self.scanBuffer = ul.win_buf_alloc(len(volts))
+        data = ctypes.cast(self.scanBuffer, ctypes.POINTER(ctypes.c_ushort))
+        for i, volt in enumerate(volts):
+            data[i] = ul.from_eng_units(self.boardNum, self.ranges[0], float(volt))
+        ul.a_out_scan(self.boardNum, channel, channel, len(volts), int(rate), self.ranges[0], self.scanBuffer,
+                      enums.ScanOptions.BACKGROUND)
+        return True
+
+    def isScanning(self) -> bool:
+        status, _, _ = ul.get_status(self.boardNum, enums.FunctionType.AOFUNCTION)
+        return status == enums.Status.RUNNING
+
+    def stopScan(self):
+        if getattr(self, "scanBuffer", None) is not None:
+            ul.stop_background(self.boardNum, enums.FunctionType.AOFUNCTION)
+            ul.win_buf_free(self.scanBuffer)
+            self.scanBuffer = None
+
+
+def pacedRamp(setField, startField:float, stopField:float, rate:float, updateRate:float=10.0):
+    # Software paced ramp from startField to stopField [mT] with rate [mT/s], calling setField(field [T])
+    # updateRate times per second. The update times are fixed in advance, so delays do not add up
+    duration = abs(stopField - startField) / rate
+    steps = max(1, math.ceil(duration * updateRate))
+    start = time.perf_counter()
+    for i, field in enumerate(np.linspace(startField, stopField, steps + 1)):
+        time.sleep(max(0.0, start + i * duration / steps - time.perf_counter()))
+        setField(field / 1000)
+
+
 class RedLabDigital:
     # The class is very focused on the usage of ME1208LS as of usage in FreqUmschalter
     # If I have time and motivation later, I will generalise it more
@@ -213,19 +252,50 @@ class FreqUmschalter():
                            3: (31.0, 33.0),
                            4: (33.0, 37.0),
                            5: (37.0, 40.0)}
+        self.currentBand = None
 
-    def setZirkulator(self, freq: float) -> bool:
-
+    def band(self, freq: float):
+        # Circulator key for freq in GHz, None if no circulator covers it
         if not (26.0 < freq < 27.0) and not (freq > 40.0) and not (freq < 8.0):
             for key, range in self.freqRanges.items():
                 if (range[0] <= freq <= range[1]):
-                    #print("Switch Ports to:", key)
-                    self.device.Dout(self.device.zirkPort[key])
-                    return True
+                    return key
+        return None
+
+    def setZirkulator(self, freq: float) -> bool:
+        key = self.band(freq)
+        if key is not None:
+            #print("Switch Ports to:", key)
+            self.device.Dout(self.device.zirkPort[key])
+            self.currentBand = key
+            return True
         else:
             print("Frequency not supported!:", freq, " GHz")
             return False
 
+    def scheduleFrequencies(self, freqList: np.ndarray, switchTime: float) -> tuple:
+        # Reorder a frequency list (1D of freqs or rows of (freq, power)) so frequencies of the same circulator
+        # band follow each other; order within a band and the band order of first appearance are kept.
+        # Returns the reordered list and the expected time saved in s, assuming switchTime is only spent on band changes
+        freqList = np.asarray(freqList)
+        freqs = freqList if freqList.ndim == 1 else freqList[:, 0]
+        bands = [self.band(float(freq)) for freq in freqs]
+
+        firstSeen = {}
+        for band in bands:
+            firstSeen.setdefault(band, len(firstSeen))
+        order = sorted(range(len(bands)), key=lambda index: firstSeen[bands[index]])
+
+        switches = 0
+        lastBand = self.currentBand
+        for index in order:
+            if bands[index] is not None and bands[index] != lastBand:
+                switches += 1
+                lastBand = bands[index]
+
+        saved = (len(bands) - switches) * switchTime # Without scheduling every setFreq waits for the switch
+        return freqList[order], saved
+
 class FreqGenerator():
     def __init__(self, device:pyvisa.Resource, Umschalter:FreqUmschalter):
         print("Frequency generator connected!")
@@ -233,45 +303,143 @@ class FreqGenerator():
 
         self.device = device
         self.umschalter = Umschalter
+        self.switchTime = 0.1 # s settling after a circulator switch
+        self.listFreqs = [] # Frequencies [GHz] loaded with loadList
+        self.listTrigger = None # Trigger mode of the running list, see startList
+        self.listIndex = None # Entry the generator is at
+
+        # Shadow copy of the settings written to the generator (SCPI header -> value), see apply
+        self.state = dict()
+        self.sent = 0 # Messages written to the bus
+        self.skipped = 0 # Settings not written, the generator already had the value
+        self.batched = 0 # Settings that shared a message with another setting
+        self.writeTime = 0.0 # s, total bus time of all writes
 
         self.deviceInit()
 
     def deviceInit(self):
-        self.write(':OUTP1:STAT OFF')
-        self.write(f':POW {0}')
-        self.write(':POW:MODE CW')
+        self.apply({':OUTP1:STAT': 'OFF', ':POW': 0, ':POW:MODE': 'CW'}, force=True)
 
     def write(self, com:str):
+        start = time.perf_counter()
         self.device.write(com)
+        self.writeTime += time.perf_counter() - start
+        self.sent += 1
 
     def query(self, com:str) -> str:
         return self.device.query(com)
 
+    def apply(self, settings:dict, force:bool=False):
+        # Write the settings that differ from the shadow state as one semicolon joined message
+        # force: write everything, e.g. when the state of the generator is unknown
+        changed = dict()
+        for header, value in settings.items():
+            value = str(float(value)) if isinstance(value, (int, float)) else str(value)
+            if force or self.state.get(header) != value:
+                changed[header] = value
+        self.skipped += len(settings) - len(changed)
+
+        if changed:
+            self.write(';'.join(f'{header} {value}' for header, value in changed.items()))
+            self.batched += len(changed) - 1
+            self.state.update(changed)
+
+    def invalidate(self):
+        # Forget the shadow state, after the generator was operated by hand or reset
+        self.state.clear()
+
+    def getStats(self) -> dict:
+        # Bus usage and the estimated time saved by skipped and batched settings
+        perWrite = self.writeTime / self.sent if self.sent else 0.0
+        return {"sent": self.sent, "skipped": self.skipped, "batched": self.batched,
+                "savedTime": (self.skipped + self.batched) * perWrite}
+
     def outputOn(self):
-        self.write(':OUTP1:STAT ON')
+        self.apply({':OUTP1:STAT': 'ON'})
 
     def outputOff(self):
-        self.write(':OUTP1:STAT OFF')
+        self.apply({':OUTP1:STAT': 'OFF'})
 
     def setPower(self,pow:float):
-        self.write(f":POW {pow}")
+        self.apply({':POW': pow})
 
     def getPower(self) -> str:
         return self.query(':POW?')
 
     def setFreq(self, freq:float, useUmschalter:bool=False):
-        if useUmschalter:
+        self.configure(freq, useUmschalter=useUmschalter)
+
+    def switchBand(self, freq:float):
+        # Set the circulator for freq, only if it is in another band than the current one
+        band = self.umschalter.band(freq)
+        if band is None:
+            self.umschalter.setZirkulator(freq) # Only warns about the unsupported frequency
+        elif band != self.umschalter.currentBand:
             self.umschalter.setZirkulator(freq)
-            time.sleep(0.1)
-        self.write(f':SOUR:FREQ:CW {freq} GHz')
+            time.sleep(self.switchTime)
+
+    def loadList(self, freqs, pows, name:str='FMR'):
+        # Upload frequencies [GHz] and powers [dBm] into the list sweep memory and let the generator learn the
+        # hardware settings, afterwards every step is a trigger or a single short command, see startList/stepList
+        self.write(f":SOUR:LIST:SEL '{name}'")
+        self.write(":SOUR:LIST:FREQ " + ", ".join(f"{float(freq) * 1e9:.0f}" for freq in freqs))
+        self.write(":SOUR:LIST:POW " + ", ".join(f"{float(pow)}" for pow in pows))
+        self.apply({':SOUR:LIST:MODE': 'STEP'})
+        self.write(":SOUR:LIST:LEAR")
+        self.query("*OPC?") # Learning takes some time
+        self.listFreqs = [float(freq) for freq in freqs]
+        self.state.pop(':SOUR:LIST:IND', None)
+
+    def startList(self, trigger:str="bus"):
+        # Switch to the loaded list, starting at the first entry. trigger selects how stepList advances it:
+        # "bus": GPIB device trigger (GET, no command to parse), "external": a pulse at the trigger input, wired
+        # from the acquisition side, advances the list, stepList only keeps track; "index": one :LIST:IND write per step
+        self.apply({':SOUR:LIST:TRIG:SOUR': 'EXT' if trigger == "external" else 'SING', ':SOUR:FREQ:MODE': 'LIST'})
+        self.listTrigger = trigger
+        self.listIndex = 0
+
+    def stepList(self, index:int, useUmschalter:bool=False):
+        # Go to entry index; the next entry is reached by a trigger, other entries (e.g. a resumed run) by index
+        if useUmschalter:
+            self.switchBand(self.listFreqs[index])
+        if index == self.listIndex:
+            return
+        if index == self.listIndex + 1 and self.listTrigger == "bus":
+            start = time.perf_counter()
+            self.device.assert_trigger()
+            self.writeTime += time.perf_counter() - start
+            self.sent += 1
+        elif index != self.listIndex + 1 or self.listTrigger != "external":
+            self.apply({':SOUR:LIST:IND': str(int(index))}, force=True)
+        self.listIndex = index
+
+    def stopList(self):
+        # Back to the CW frequency and power
+        self.apply({':SOUR:FREQ:MODE': 'CW'})
+        self.listTrigger = None
+        self.listIndex = None
+
+    def configure(self, freq:float=None, pow:float=None, output:bool=None, useUmschalter:bool=False):
+        # Frequency, power and output state in one message, only the given and changed ones are sent
+        settings = dict()
+        if output is False:
+            settings[':OUTP1:STAT'] = 'OFF' # Switch off before changing anything else
+        if freq is not None:
+            if useUmschalter:
+                self.switchBand(freq)
+            settings[':SOUR:FREQ:CW'] = f'{freq} GHz'
+        if pow is not None:
+            settings[':POW'] = pow
+        if output is True:
+            settings[':OUTP1:STAT'] = 'ON'
+        self.apply(settings)
 
     def getFreq(self) -> str:
         return self.query(':SOUR:FREQ?')
 
     def close(self):
-        self.setFreq(1.0)
-        self.setPower(1.0)
-        self.toggleOff()
+        self.configure(1.0, 1.0, False)
+        print("Frequency generator:", self.getStats())
 
 
 class HallSensor():
@@ -295,6 +463,77 @@ class HallSensor():
         self.write(rang)
 
 
+class HallService(QThread):
+    # Only owner of the Hall sensor: samples the field at rate [Hz] and keeps the latest value plus a history,
+    # GUI and measurement threads read from here instead of sharing the GPIB device
+    fieldSig = pyqtSignal(float) # Every new value [mT]
+
+    def __init__(self, sensor:HallSensor, rate:float=10.0, history:float=60.0):
+        super().__init__()
+        self.sensor = sensor
+        self.interval = 1 / rate
+        self.history = RingBuffer(int(history * rate), 2) # columns: host time [s], field [mT]
+        self.busLock = threading.Lock() # Serializes all access to the sensor
+        self.newSample = threading.Condition()
+        self.latestStart = -math.inf # Host time the query of the latest value was sent
+        self.latestTime = math.nan
+        self.latestField = math.nan
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running:
+            start = time.perf_counter()
+            try:
+                with self.busLock:
+                    field = self.sensor.getField()
+            except Exception as e:
+                print("Hall sensor read failed:", e)
+                time.sleep(self.interval)
+                continue
+            now = time.perf_counter()
+
+            with self.newSample:
+                self.history.extend(np.array([[(start + now) / 2, field]]))
+                self.latestStart = start
+                self.latestTime = (start + now) / 2
+                self.latestField = field
+                self.newSample.notify_all()
+            self.fieldSig.emit(field)
+
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - start)))
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def getField(self, since:float=None, timeout:float=2.0) -> float:
+        # Newest value whose query started at host time since or later (default: now, like HallSensor.getField)
+        # Callers pass the time the field was last changed, so a value sampled after that returns without waiting
+        request = time.perf_counter() if since is None else since
+        if not self.isRunning():
+            with self.busLock:
+                return self.sensor.getField()
+        with self.newSample:
+            if not self.newSample.wait_for(lambda: self.latestStart >= request, timeout):
+                print("Hall sensor service did not deliver a new value, using the last one")
+            return self.latestField
+
+    def getLatest(self) -> tuple:
+        # (host time, field [mT]) of the newest value, without waiting
+        with self.newSample:
+            return self.latestTime, self.latestField
+
+    def getHistory(self, since:float) -> np.ndarray:
+        # All values (time, field) measured after host time since
+        with self.newSample:
+            return self.history.since(since)
+
+    def switchRange(self, range:float):
+        with self.busLock:
+            self.sensor.switchRange(range)
+
+
 class Polariser:
     def __init__(self, device):
 
@@ -323,7 +562,49 @@ class Polariser:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.redbox.exit()
 
+class RotationStage:
+    # Interface of the sample rotation stage used by AngularDependence
+    # moveTo only starts the movement, so the stage can rotate while the magnet ramps; waitMoved blocks until arrived
+    def moveTo(self, angle:float):
+        raise NotImplementedError
+
+    def getAngle(self) -> float:
+        raise NotImplementedError
+
+    def isMoving(self) -> bool:
+        raise NotImplementedError
+
+    def waitMoved(self, timeout:float=120.0):
+        start = time.perf_counter()
+        while self.isMoving():
+            if time.perf_counter() - start > timeout:
+                raise TimeoutError("Rotation stage did not reach its target angle")
+            time.sleep(0.05)
+
+class SimulatedRotationStage(RotationStage):
+    # Rotation stage without hardware, for testing: rotates with speed [deg/s] from the moment moveTo is called
+    def __init__(self, speed:float=10.0, angle:float=0.0):
+        print("Simulated rotation stage connected!")
+        self.speed = speed
+        self.startAngle = angle
+        self.targetAngle = angle
+        self.startTime = time.perf_counter()
+
+    def moveTo(self, angle:float):
+        self.startAngle = self.getAngle()
+        self.targetAngle = angle
+        self.startTime = time.perf_counter()
+
+    def getAngle(self) -> float:
+        distance = self.targetAngle - self.startAngle
+        travelled = min(abs(distance), self.speed * (time.perf_counter() - self.startTime))
+        return self.startAngle + math.copysign(travelled, distance)
+
+    def isMoving(self) -> bool:
+        return self.getAngle() != self.targetAngle
+
 class FieldMove(QThread):
+    # Ramps the magnet from currentField to desiredField [mT] with maxFieldSpeed [mT/s]
     def __init__(self, Magnet,calibration:interp1d, currentField:float, desiredField:float, maxFieldSpeed=25, channel:int=2):
         super(FieldMove, self).__init__()
         self.calib = calibration
@@ -334,30 +615,46 @@ class FieldMove(QThread):
         self.Magnet = Magnet
 
     def run(self):
-        steps = math.ceil( abs(self.curField - self.desField ) / self.speed )
-
-        for fieldStep in np.linspace(self.curField, self.desField , num=10 * steps + 1):
-            self.Magnet.setField(fieldStep/1000)
-            time.sleep(0.2)
+        self.Magnet.rampField(self.curField, self.desField, self.speed)
 
 class MagnetPowerRedLab(RedLab):
     def __init__(self, calibration:interp1d, channel:int=2):
         super(MagnetPowerRedLab, self).__init__()
         self.calib = calibration
+        self.channel = channel
+        self.rampUpdateRate = 100.0 # S/s of the analog output scan during ramps
 
-    def setField(self, desiredField:float):
-        print("Desired Field:",desiredField)
+    def fieldToVolt(self, field):
+        # Calibrated control voltage(s) for field [T], limited to the 0-7 V input of the power supply
         try:
-            volt = self.calib(desiredField)
+            volt = self.calib(field)
         except ValueError:
-            print("ERROR:", desiredField)
-            if volt <= 0:
-                volt = 0.0
-            elif volt >= 7.0:
-                volt = 7.0
+            print("ERROR:", field)
+            volt = self.calib(np.clip(field, self.calib.x[0], self.calib.x[-1]))
+        return np.clip(volt, 0.0, 7.0)
+
+    def setField(self, desiredField:float):
+        print("Desired Field:",desiredField)
+        volt = float(self.fieldToVolt(desiredField))
 
         print("Volt:",volt, "WantedField:",desiredField)
-        self.VOut(2, volt)
+        self.VOut(self.channel, volt)
+
+    def rampField(self, startField:float, stopField:float, rate:float, wait:bool=True):
+        # Ramp from startField to stopField [mT] with rate [mT/s]. The whole voltage waveform is computed in advance
+        # and played out by the board as hardware timed scan; boards without paced output fall back to pacedRamp
+        # wait=False returns right after the scan started, see isScanning
+        duration = abs(stopField - startField) / rate
+        steps = max(1, math.ceil(duration * self.rampUpdateRate))
+        volts = self.fieldToVolt(np.linspace(startField, stopField, steps + 1) / 1000)
+
+        if not self.VOutScan(self.channel, volts, steps / max(duration, 1 / self.rampUpdateRate)):
+            pacedRamp(self.setField, startField, stopField, rate)
+            return
+        if wait:
+            while self.isScanning():
+                time.sleep(0.05)
+            self.stopScan()
 
 class MagnetPowerSupply:
     def __init__(self, device:pyvisa.Resource, calibration:interp1d):
@@ -398,15 +695,80 @@ class MagnetPowerSupply:
         currVal = self.calib(desiredField)
         self.write(f"SOUR:CUR {currVal}")
 
+    def rampField(self, startField:float, stopField:float, rate:float, wait:bool=True):
+        # Same interface as MagnetPowerRedLab.rampField, always software paced
+        pacedRamp(self.setField, startField, stopField, rate)
+
     def close(self):
         self.write(b"SOUR:VOL 0.0\n")
         self.write(b"SOUR:CUR 0.0\n")
 
 
+class RingBuffer:
+    # Fixed size 2D numpy buffer, rows are samples and columns channels (e.g. time, x, y, phase)
+    # Once full, the oldest samples get overwritten
+    def __init__(self, size:int, columns:int):
+        self.size = size
+        self.data = np.zeros((size, columns))
+        self.written = 0 # Total number of samples ever written
+
+    def __len__(self):
+        return min(self.written, self.size)
+
+    def extend(self, block:np.ndarray):
+        n = block.shape[0]
+        if n > self.size:
+            self.written += n - self.size
+            block = block[-self.size:]
+            n = self.size
+
+        pos = self.written % self.size
+        first = min(n, self.size - pos)
+        self.data[pos:pos + first] = block[:first]
+        self.data[:n - first] = block[first:]
+        self.written += n
+
+    def last(self, n:int) -> np.ndarray:
+        # Returns copy of the newest n samples in chronological order
+        n = min(n, len(self))
+        return self.data[(self.written - n + np.arange(n)) % self.size]
+
+    def since(self, t:float, column:int=0) -> np.ndarray:
+        # Returns all buffered samples with data[:, column] >= t in chronological order
+        # column has to be monotonic (e.g. time), so the start is found by bisection without copying the buffer
+        low = self.written - len(self)
+        high = self.written
+        while low < high:
+            middle = (low + high) // 2
+            if self.data[middle % self.size, column] < t:
+                low = middle + 1
+            else:
+                high = middle
+        return self.last(self.written - low)
+
+    def clear(self):
+        self.written = 0
+
+
 class LockIn_SR830:
+    # Buffer sample rates in Hz for SRAT 0..13, SRAT 14 stores one point per trigger()
+    SAMPLE_RATES = [0.0625 * 2 ** i for i in range(14)]
+    BUFFER_SIZE = 16383 # Points per channel in the internal buffer
+
     def __init__(self, device:pyvisa.Resource):
         self.device = device
 
+        # Internal data buffer, see startStream
+        self.streaming = False
+        self.streamStart = None
+        self.streamRate = None
+        self.streamRead = 0 # Buffer points already transferred
+        self.streamTimes = [] # Host times of the triggers in trigger mode
+        self.streamData = np.empty((0, 4))
+        self.bufferFull = False
+
+        self.filterOrder = int(self.query('OFSL?')) + 1 # Low pass slope 6/12/18/24 dB/oct, used by SettleDetector
+
     @property
     def TC(self):
         return self._TC
@@ -437,8 +799,73 @@ class LockIn_SR830:
     def query(self, com: str) -> str:
         return self.device.query(com)
 
-    def getData(self):
-        return {"x": float(self.query('OUTP? 1')), "y": float(self.query('OUTP? 2')), 'phase': float(self.query('OUTP? 4'))}
+    def getData(self) -> dict:
+        # X, Y and phase taken at the same moment with one query
+        # The SR830 reports the phase in deg, it is converted to rad like the phase of LockIn_Zurich
+        request = time.perf_counter()
+        x, y, phase = (float(val) for val in self.query('SNAP? 1,2,4').split(','))
+        return {"x": x, "y": y, "phase": math.radians(phase), "time": request}
+
+    def startStream(self, rateIndex:int=13, duration:float=None):
+        # Record X (CH1) and Y (CH2) in the internal buffer at SAMPLE_RATES[rateIndex] (512 Hz by default),
+        # duration: expected recording time in s, the rate is lowered until that fits into the buffer
+        # rateIndex 14 stores a point on every trigger(). Single shot: recording stops after BUFFER_SIZE points
+        # (32 s at 512 Hz), readBuffer warns once that happened. Loop mode is not used, once the buffer wrapped
+        # SPTS? stays at BUFFER_SIZE and the number of new points can not be told anymore
+        self.write('DDEF 1,0,0')
+        self.write('DDEF 2,0,0')
+        self.write('SEND 0')
+        if duration is not None:
+            while rateIndex > 0 and self.SAMPLE_RATES[min(rateIndex, 13)] * duration >= self.BUFFER_SIZE:
+                rateIndex -= 1
+        self.write(f'SRAT {int(rateIndex)}')
+        self.write('REST')
+        self.write('STRT')
+        self.streamStart = time.perf_counter()
+        self.streamRate = self.SAMPLE_RATES[rateIndex] if rateIndex < 14 else None
+        self.streamRead = 0
+        self.streamTimes = []
+        self.streamData = np.empty((0, 4))
+        self.bufferFull = False
+        self.streaming = True
+
+    def trigger(self):
+        self.write('TRIG')
+        self.streamTimes.append(time.perf_counter())
+
+    def stopStream(self):
+        self.write('PAUS')
+        self.streaming = False
+
+    def readBuffer(self) -> np.ndarray:
+        # Transfer the points stored since the last call as binary floats (TRCB), rows: host time, x, y, phase [rad]
+        stored = int(self.query('SPTS?'))
+        if stored >= self.BUFFER_SIZE and not self.bufferFull:
+            print(f"SR830 buffer full after {self.BUFFER_SIZE} points, recording stopped; use a lower rate")
+            self.bufferFull = True
+        count = stored - self.streamRead
+        if count <= 0:
+            return np.empty((0, 4))
+
+        x, y = (self.device.query_binary_values(f'TRCB? {channel},{self.streamRead},{count}', datatype='f',
+                                                is_big_endian=False, header_fmt='empty', data_points=count,
+                                                expect_termination=False, container=np.array)
+                for channel in (1, 2))
+        if self.streamRate is not None:
+            times = self.streamStart + np.arange(self.streamRead, stored) / self.streamRate
+        else:
+            times = np.array(self.streamTimes[self.streamRead:stored])
+        self.streamRead = stored
+        return np.column_stack((times, x, y, np.arctan2(y, x)))
+
+    def getStream(self, since:float) -> np.ndarray:
+        # All buffered samples (time, x, y, phase) taken after host time since, same as LockIn_Zurich.getStream
+        self.streamData = np.concatenate((self.streamData, self.readBuffer()))
+        return self.streamData[np.searchsorted(self.streamData[:, 0], since):]
+
+    def close(self):
+        if self.streaming:
+            self.stopStream()
 
 
 class LockIn_Zurich:
@@ -467,6 +894,21 @@ class LockIn_Zurich:
         print("Connected to Zürich Instruments Lock-In!")
 
         self.daq = daq
+        self.filterOrder = 3 # Low pass order set above, used by SettleDetector
+        self.daqLock = threading.Lock() # ziDAQServer is shared between the stream thread and the measurement
+
+        # Streaming acquisition: a background thread polls the subscribed sample node into a ring buffer
+        # columns: host time [s], x, y, phase
+        self.samplePath = '/dev280/demods/0/sample'
+        self.rate = 10e3
+        self.clockbase = float(daq.getInt('/dev280/clockbase')) # Device timestamp ticks per second
+        self.clockOffset = None # host time - device time
+        self.buffer = RingBuffer(int(60 * self.rate), 4) # Last 60 s of samples
+        self.bufferLock = threading.Lock()
+        self.pollInterval = 0.01 # s
+        self.avrgTime = 0.01 # s, window of buffered samples averaged per getData() call
+        self.streaming = False
+        self.startStream()
 
     @property
     def TC(self):
@@ -474,7 +916,8 @@ class LockIn_Zurich:
 
     @TC.setter
     def TC(self, val:float):
-        self.daq.setDouble('/dev280/demods/0/timeconstant', val)
+        with self.daqLock:
+            self.daq.setDouble('/dev280/demods/0/timeconstant', val)
         self._TC = val
 
     @property
@@ -483,9 +926,10 @@ class LockIn_Zurich:
 
     @modFreq.setter
     def modFreq(self, val:float):
-        if val > 450000:
-            self.daq.setInt('/dev280/demods/0/sinc', 0)  # Activate Sinc filtering
-        self.daq.setDouble('/dev280/oscs/0/freq', val)  # Set modulation frequency
+        with self.daqLock:
+            if val > 450000:
+                self.daq.setInt('/dev280/demods/0/sinc', 0)  # Activate Sinc filtering
+            self.daq.setDouble('/dev280/oscs/0/freq', val)  # Set modulation frequency
         self._modFreq = val
 
     @property
@@ -494,15 +938,26 @@ class LockIn_Zurich:
 
     @modAmp.setter
     def modAmp(self, val: float):
-        if val <= 1:
-            self.daq.setDouble('/dev280/sigouts/0/range', 1)
-            self.daq.setDouble('/dev280/sigouts/0/amplitudes/6', val)  # Set modulation amplitude
-        elif val > 1:
-            self.daq.setDouble('/dev280/sigouts/0/range', 10)
-            self.daq.setDouble('/dev280/sigouts/0/amplitudes/6', val/10)  # Set modulation amplitude
+        with self.daqLock:
+            if val <= 1:
+                self.daq.setDouble('/dev280/sigouts/0/range', 1)
+                self.daq.setDouble('/dev280/sigouts/0/amplitudes/6', val)  # Set modulation amplitude
+            elif val > 1:
+                self.daq.setDouble('/dev280/sigouts/0/range', 10)
+                self.daq.setDouble('/dev280/sigouts/0/amplitudes/6', val/10)  # Set modulation amplitude
 
         self._modAmp = val
 
+    @property
+    def phaseShift(self):
+        return self._phaseShift
+
+    @phaseShift.setter
+    def phaseShift(self, val: float):
+        with self.daqLock:
+            self.daq.setDouble('/dev280/demods/0/phaseshift', val)
+        self._phaseShift = val
+
     @property
     def range(self):
         return self._range
@@ -513,22 +968,90 @@ class LockIn_Zurich:
         self._range = val
 
     def outputOff(self):
-        self.daq.setInt('/dev280/sigouts/0/on', 0)
+        with self.daqLock:
+            self.daq.setInt('/dev280/sigouts/0/on', 0)
 
     def outputOn(self):
-        self.daq.setInt('/dev280/sigouts/0/on', 1)
+        with self.daqLock:
+            self.daq.setInt('/dev280/sigouts/0/on', 1)
 
-    def getData(self) -> list:
-        return self.daq.getSample("/dev280/demods/0/sample")
+    def startStream(self):
+        if self.streaming:
+            return
+        self.streaming = True
+        self.streamThread = threading.Thread(target=self._pollStream, daemon=True)
+        self.streamThread.start()
+
+    def stopStream(self):
+        self.streaming = False
+        if self.streamThread.is_alive():
+            self.streamThread.join()
+
+    def _pollStream(self):
+        # Poll everything the data server collected for the subscribed node since the last poll
+        # Device timestamps are converted to host time (time.perf_counter), the offset is the smallest
+        # host - device difference seen so far, which is the one with the lowest transfer latency
+        while self.streaming:
+            with self.daqLock:
+                polled = self.daq.poll(0.001, 10, 0, True)
+            hostTime = time.perf_counter()
+
+            sample = polled.get(self.samplePath)
+            if sample is not None and len(sample["timestamp"]) > 0:
+                devTime = np.asarray(sample["timestamp"], dtype=float) / self.clockbase
+                offset = hostTime - devTime[-1]
+                if self.clockOffset is None or offset < self.clockOffset:
+                    self.clockOffset = offset
+
+                block = np.column_stack((devTime + self.clockOffset, sample["x"], sample["y"], sample["phase"]))
+                with self.bufferLock:
+                    self.buffer.extend(block)
+
+            time.sleep(self.pollInterval)
+
+    def getStream(self, since:float) -> np.ndarray:
+        # All buffered samples (time, x, y, phase) taken after host time since
+        with self.bufferLock:
+            return self.buffer.since(since)
+
+    def getData(self, avrgTime:float=None, timeout:float=1.0) -> dict:
+        # Average of the buffered samples within avrgTime before the newest sample
+        # Waits until the buffer holds a sample taken after the call, so the value is as fresh as getSample
+        # Falls back to a single getSample round trip if the stream does not deliver in time
+        if avrgTime is None:
+            avrgTime = self.avrgTime
+
+        request = time.perf_counter()
+        while self.streaming and time.perf_counter() - request < timeout:
+            with self.bufferLock:
+                if len(self.buffer) > 0 and self.buffer.last(1)[0, 0] >= request:
+                    n = max(1, int(avrgTime * self.rate))
+                    block = self.buffer.last(n)
+                    break
+            time.sleep(self.pollInterval / 2)
+        else:
+            with self.daqLock:
+                sample = self.daq.getSample(self.samplePath)
+            return {"x": float(sample["x"]), "y": float(sample["y"]), "phase": float(sample["phase"]),
+                    "time": request}
+
+        x = float(np.mean(block[:, 1]))
+        y = float(np.mean(block[:, 2]))
+        return {"x": x, "y": y, "phase": math.atan2(y, x), "time": float(block[-1, 0])}
 
     def getX(self) -> float:
-        return float(self.daq.getSample("/dev280/demods/0/sample")["x"])
+        return self.getData()["x"]
 
     def getY(self) -> float:
-        return float(self.daq.getSample("/dev280/demods/0/sample")["y"])
+        return self.getData()["y"]
 
     def getTheta(self) -> float:
-        return float(self.daq.getSample("/dev280/demods/0/sample")["phase"])
+        return self.getData()["phase"]
+
+    def close(self):
+        self.stopStream()
+        with self.daqLock:
+            self.daq.unsubscribe(self.samplePath)
 
 
 if __name__ == '__main__':
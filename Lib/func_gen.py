@@ -2,13 +2,22 @@
 # Idea is, these Classes should create and return a string which in the end via excec(....., globals()) can be turned
 # into a python function and in the end into a model for fitting using lmfit
 import math as m
+import numpy as np
 from asteval import asteval
-from typing import List
+from lmfit import Model
+from typing import List, Tuple
+
+try:
+    import sympy
+except ImportError:
+    sympy = None
 
 class Fit_Models():
     # Todo: Make MODELS as Object; Args, Bounds, Stepsize... as property
     def __init__(self):
         self._load_models()
+        self._compile_models()
+        self.compiled = dict()  # tuple of model names -> (function string, lmfit Model), see getCompiledModel
 
     def _load_models(self):
         # Loads a .txt file where the models are stored
@@ -70,6 +79,57 @@ class Fit_Models():
 
         self.MODELS = MODELS
 
+    def _compile_models(self):
+        # Compile every model once into a vectorized numpy function f(B, *args). Parameters can be arrays, e.g.
+        # shape (K, 1) against B of shape (N,) evaluates K parameter sets at once, result shape (K, N)
+        # With sympy installed the partial derivatives df/darg are derived symbolically and compiled the same way
+        for name, model in self.MODELS.items():
+            if 'func' not in model:
+                continue
+            args = [arg.strip() for arg in model['args']]
+            func = model['func'].strip()
+            model['callable'] = eval('lambda B, {}: {}'.format(', '.join(args), func), {'np': np})
+            model['derivs'] = None
+            if sympy is not None:
+                symbols = sympy.symbols(['B'] + args)
+                expr = sympy.sympify(func.replace('np.', ''), locals=dict(zip(['B'] + args, symbols)))
+                model['derivs'] = [sympy.lambdify(symbols, sympy.diff(expr, symbol), 'numpy') for symbol in symbols[1:]]
+
+    def _split(self, models: List[str]) -> list:
+        # "Lorentz 1" -> (model dict, [dB1, R1, A1])
+        parts = []
+        for model in models:
+            name, index = model.split(" ")
+            func = self.MODELS[name]
+            parts.append((func, [arg.strip() + index for arg in func['args']]))
+        return parts
+
+    def evaluate(self, models: List[str], B, params: dict):
+        # Sum of the compiled models, params: parameter name (e.g. dB1) -> value or array of values
+        return sum(func['callable'](B, *(params[arg] for arg in args)) for func, args in self._split(models))
+
+    def jacobian(self, models: List[str], B, params: dict) -> dict:
+        # Analytic partial derivatives parameter name -> array like B, None if sympy is not installed
+        if sympy is None:
+            return None
+        jac = dict()
+        for func, args in self._split(models):
+            values = [params[arg] for arg in args]
+            for arg, deriv in zip(args, func['derivs']):
+                jac[arg] = np.broadcast_to(deriv(B, *values), np.shape(B))
+        return jac
+
+    def getDfun(self, models: List[str]):
+        # Jacobian in the form lmfit's leastsq expects as Dfun (with col_deriv=1) for Model.fit, None without sympy
+        if sympy is None:
+            return None
+
+        def dfun(params, data, weights, B, **kws):
+            jac = self.jacobian(models, B, {name: par.value for name, par in params.items()})
+            scale = 1 if weights is None else weights
+            return np.array([jac[name] * scale for name, par in params.items() if par.vary])
+        return dfun
+
     def getModelFunc(self, models: List[str], spectra: int) -> List[str]:
         # From models list extract model names plus index number , eg. "Lorentz 1" + "Dyson 2" ....
         # Then get their func_fmt and format {} to index number.
@@ -92,6 +152,25 @@ class Fit_Models():
         func = "def modelFitFunc_{0}(B{1}):\n\treturn({2})".format(spectra, func_args, func_body)
         return func, "modelFitFunc_{}".format(spectra), func_args
 
+    def getCompiledModel(self, models: List[str]) -> Tuple[str, Model]:
+        # Model of the sum of the compiled models (see _compile_models), built once per combination of models
+        # All Spectra with the same model names share the Model, each Spectra makes its own Parameters
+        # The generated function only passes its arguments on, lmfit needs the parameter names in its signature
+        key = tuple(models)
+        if key not in self.compiled:
+            name = "modelFitFunc_{}".format(len(self.compiled))
+            namespace = dict()
+            func_args = str()
+            func_body = []
+            for index, (model, args) in enumerate(self._split(models)):
+                namespace["model_{}".format(index)] = model['callable']
+                func_args += ", " + ", ".join(args)
+                func_body.append("model_{}(B, {})".format(index, ", ".join(args)))
+            func = "def {0}(B{1}):\n\treturn {2}".format(name, func_args, " + ".join(func_body))
+            exec(func, namespace)
+            self.compiled[key] = (func, Model(namespace[name]))
+        return self.compiled[key]
+
 
 if __name__ == '__main__':
     Fit_Models()
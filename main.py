@@ -17,7 +17,9 @@ from Lib.SpectraClass import Spectra
 from Lib.MeasurementClass import Measurement
 from Lib.devices import *
 from Lib.customwidgets import *
-from Lib.Measurement import SweepMeasurement, FreqSweepMeasurement
+from Lib.Measurement import SweepMeasurement, FreqSweepMeasurement, RampSweepMeasurement, AdaptiveSweepMeasurement, \
+    AngularDependence, Checkpoint
+from Lib.DataWriter import openDataWriter, exportText, BufferedWriter
 
 from contextlib import ExitStack
 
@@ -33,9 +35,10 @@ class MyForm(QMainWindow):
         self.field = 0.0
 
         self.measurementTypes = {0: self.startFieldSweep, 1: self.startFreqSweep,
-                                 2: self.startFieldAngDep, 3: self.startFreqAngDep}
+                                 2: self.startFieldAngDep, 3: self.startFreqAngDep,
+                                 4: self.startRampSweep, 5: self.startAdaptiveSweep}
 
-        self.sweepDirections = {0: "up", 1: "down"}
+        self.sweepDirections = {0: "up", 1: "down", 2: "serpentine"}
 
         self.initDevices()
         self.ui.pushButton.clicked.connect(self.setDefaultConfig)
@@ -69,6 +72,13 @@ class MyForm(QMainWindow):
         self.ui.pausebutton.clicked.connect(self.debug)
         self.ui.spectraScrollBar.setMaximum(0)
 
+        self.ui.spinBox.setMinimum(1)
+        self.ui.checkBox.setEnabled(True)
+        self.ui.checkBox.stateChanged.connect(lambda state: self.ui.spinBox.setEnabled(bool(state)))
+
+        self.ui.actionResume_Measurement.triggered.connect(self.resumeMeasurement)
+        self.ui.actionExport_Data.triggered.connect(self.exportDataFile)
+
     def debug(self):
         self.outputName = "DebugEntry"
         self.gatherInfos()
@@ -94,7 +104,11 @@ class MyForm(QMainWindow):
 
         self.ExcelWriter = stack.enter_context(ExcelWriter(self.ui.tableWidgetExcel, 'LogBook.xlsx'))
 
-        self.TslMeter = HallSensor(stack.enter_context(rm.open_resource(self.config["Hall Sensor"].get("address"))))
+        # Only the service thread talks to the Hall sensor, everything else reads its values
+        self.TslMeter = HallService(HallSensor(stack.enter_context(rm.open_resource(self.config["Hall Sensor"].get("address")))),
+                                    self.config.getfloat("Hall Sensor", "sample rate [hz]", fallback=10.0))
+        self.TslMeter.start()
+        stack.callback(self.TslMeter.stop)
         #self.RedLab = RedLab()
         #self.LockIn = LockIn_SR830(stack.enter_context(rm.open_resource('GPIB0::8::INSTR')))
         self.Umschalter = FreqUmschalter(stack.enter_context(RedLabDigital(1)))
@@ -109,12 +123,20 @@ class MyForm(QMainWindow):
         self.Magnet = MagnetPowerRedLab(self.calibration) #MagnetPowerSupply(self.config["Magnet Powersupply"].get("address"))
         self.setField(0.0)
 
+        stageType = self.config.get("Rotation Stage", "type", fallback="Simulator")
+        if stageType == "Simulator":
+            self.Stage = SimulatedRotationStage(self.config.getfloat("Rotation Stage", "speed [deg/s]", fallback=10.0))
+        else:
+            raise ValueError("Unknown rotation stage type: " + stageType)
+
     def changeMeasurementType(self):
         # Combobox index
         # 0: Field Sweep
         # 1: Frequency Sweep
         # 2: Ang-Dep-Field-Domain
         # 3: Ang-Dep-Freq-Domain
+        # 4: Field Sweep (continuous ramp)
+        # 5: Field Sweep (adaptive refinement)
         measType = self.ui.comboBox.currentIndex()
         try:
             self.ui.startbutton.pressed.disconnect()
@@ -181,11 +203,12 @@ class MyForm(QMainWindow):
             pass
 
     def timerGetField(self):
-        # Get field value from Hall sensor
-        # Sense command:
-        #         "F\r"
-        #self.field = self.hallDevice.getField()
-        self.field = self.TslMeter.getField()
+        # Latest field value of the Hall sensor service, no bus access from the GUI thread
+        # NaN until the service delivered its first value, keep the previous field meanwhile
+        field = self.TslMeter.getLatest()[1]
+        if math.isnan(field):
+            return
+        self.field = field
         self.ui.fieldlabel.setText(str(self.field) + " [mT]")
 
     def timerCheckDesiredField(self):
@@ -195,12 +218,6 @@ class MyForm(QMainWindow):
         else:
             self.ui.fieldlabel.setStyleSheet("background-color: lime")
 
-    def toggleFieldTimer(self, inUse:bool):
-        if inUse:
-            self.fieldTimer.stop()
-        elif not inUse:
-            self.fieldTimer.start()
-
     def isFieldMoving(self, val:bool):
         self.desiredField = val*1000
 
@@ -215,8 +232,14 @@ class MyForm(QMainWindow):
         self.infos["TC"] = float(self.ui.spinBoxTC.value())
         self.infos["ModFreq"] = float(self.ui.spinBoxModFreq.value())
         self.infos["ModAmp"] = float(self.ui.spinBoxModAmp.value()) # Peak to Peak amplitude in V
-        self.infos["avrg"] = 1
+        self.infos["avrg"] = self.ui.spinBox.value() if self.ui.checkBox.isChecked() else 1
+        self.infos["targetSNR"] = self.config["Lock-In"].get("Target SNR", 0)
         self.infos["maxFieldSpeed"] = self.config["Magnet Powersupply"].get("Maximum field rate [mT/s]")
+        self.infos["rampRate"] = self.config["Magnet Powersupply"].get("Ramp rate [mT/s]", 0)
+        self.infos["maxSettle"] = self.config["Lock-In"].get("Maximum settle time [TC]", 7)
+        self.infos["listMode"] = self.config["R&S-Frequency Generator"].getboolean("List mode", False)
+        self.infos["listTrigger"] = self.config["R&S-Frequency Generator"].get("List trigger", "bus")
+        self.infos["settleTol"] = self.config["Lock-In"].get("Settle tolerance [noise]", 3)
         self.infos["calibration"] = self.calibration
         self.infos["CalibN"] = "calibMagnet.dat"
         self.infos["Notes"] = ""
@@ -241,40 +264,63 @@ class MyForm(QMainWindow):
     def errorMSG(self, *args):
         print(args)
 
-    def startFieldSweep(self):
+    def startFieldSweep(self, measClass=SweepMeasurement):
         print("run Better")
         self.newDataFile("FieldSweep")
         self.gatherInfos()
-        self.measThread = SweepMeasurement(self.Magnet, self.TslMeter, self.FreqGen, self.LockIn, self.infos)
+        if measClass is SweepMeasurement and self.infos["avrg"] <= 1: # Only point by point sweeps can be resumed
+            self.setCheckpoint("FieldSweep")
+
+        if self.infos["avrg"] > 1 and measClass is SweepMeasurement: # Only the plain sweep averages
+            self.openDataFile(("field", "x", "y", "phase", "xVar", "yVar", "passes"))
+        else:
+            self.openDataFile(("field", "x", "y", "phase"))
+        self.runFieldSweep(measClass)
+        self.clearPlotData()
+
+        self.ExcelWriter.addTableRow(self.infos)
+
+    def runFieldSweep(self, measClass=SweepMeasurement):
+        self.measThread = measClass(self.Magnet, self.TslMeter, self.FreqGen, self.LockIn, self.infos)
 
         self.measThread.start()
         self.measThread.dataOutSig.connect(self.getSweepData)
+        self.measThread.previewSig.connect(self.plotSweepData)
+        self.measThread.passDoneSig.connect(self.clearPlotData)
         self.measThread.fieldMoveSig.connect(self.isFieldMoving)
-        self.measThread.meterUsageSig.connect(self.toggleFieldTimer)
+        self.measThread.doneSig.connect(self.measurementDone)
         self.measThread.finished.connect(self.closeOutPutFile)
         self.measThread.errorSig.connect(self.errorMSG)
 
         self.ui.progressBar.setMaximum(99)
 
+    def startRampSweep(self):
+        self.startFieldSweep(RampSweepMeasurement)
 
-        self.outputFile.write("Magnetic Field [T]\tX-Channel\tY-Channel\tPhase\n")
-        self.clearPlotData()
-
-        self.ExcelWriter.addTableRow(self.infos)
+    def startAdaptiveSweep(self):
+        self.startFieldSweep(AdaptiveSweepMeasurement)
 
     def closeOutPutFile(self):
         self.outputFile.close()
 
+    def writePoint(self, values:tuple, progress:dict=None):
+        # A failing data file (full disk, lost network share) stops the measurement, the field is ramped down
+        # by the thread and the checkpoint keeps the last flushed point for resuming
+        if self.outputFile.write(values, progress) or self.measThread.stopEvent.is_set():
+            return
+        print("Writing", self.outputFile.path, "failed, stopping the measurement:", self.outputFile.error)
+        self.stopThread()
+
+    def measurementDone(self):
+        # Measurement completed, the writer removes the checkpoint after the last point is flushed
+        self.outputFile.finish()
+
     def stopThread(self):
+        # Cooperative stop instead of terminate(): a killed thread could keep a lock of the Hall service or the
+        # Lock-In held and freeze the GUI. The thread switches the outputs off and ramps the field down itself,
+        # the data file is closed by finished -> closeOutPutFile and the checkpoint is kept for resuming
         if self.measThread.isRunning():
-            self.measThread.terminate()
-            self.toggleFieldTimer(False)
-            self.outputFile.close()
-            self.LockIn.outputOff()
-            self.FreqGen.outputOff()
-            self.FreqGen.setFreq(5.0)
-            self.FreqGen.setPower(5.0)
-            self.setField(0.0)
+            self.measThread.stop()
 
     def startFreqSweep(self):
         self.newDataFile("FreqSweep")
@@ -283,38 +329,132 @@ class MyForm(QMainWindow):
 
         fname = QFileDialog.getOpenFileName(self, 'Open Frequency list', '/home')
         if fname[0]:
-            freqSweepData = np.loadtxt(fname[0]) # I will change this later!
+            freqSweepData = np.loadtxt(fname[0], ndmin=2) # I will change this later!
         else:
             return
 
+        if self.config["R&S-Frequency Generator"].getboolean("Group by circulator", False):
+            freqSweepData, saved = self.Umschalter.scheduleFrequencies(freqSweepData, self.FreqGen.switchTime)
+            print(f"Frequencies grouped by circulator band, expected to save {saved:.1f} s of switching")
+
         self.infos["MWFreq"] = 'FreqSweep'
         self.infos['FreqSweep'] = freqSweepData
+        self.setCheckpoint("FreqSweep")
+        self.openDataFile(("field", "x", "y", "phase", "freq", "pow"))
+        self.runFreqSweep()
+        self.clearPlotData()
+
+        self.ExcelWriter.addTableRow(self.infos)
 
+    def runFreqSweep(self):
         self.measThread = FreqSweepMeasurement(self.Magnet, self.TslMeter,self.LockIn, self.FreqGen, self.infos)
         self.measThread.start()
         self.measThread.freqDataOutSig.connect(self.getFreqSweepData)
+        self.measThread.previewSig.connect(self.plotSweepData)
+        self.measThread.passDoneSig.connect(self.clearPlotData)
         self.measThread.fieldMoveSig.connect(self.isFieldMoving)
         self.measThread.freqSweepDoneSig.connect(self.freqSweepDone)
-        self.measThread.meterUsageSig.connect(self.toggleFieldTimer)
         self.measThread.errorSig.connect(self.errorMSG)
+        self.measThread.doneSig.connect(self.measurementDone)
         self.measThread.finished.connect(self.closeOutPutFile)
 
         self.ui.progressBar.setMaximum(99)
 
-        self.outputFile.write("Magnetic Field [T]\tX-Channel\tY-Channel\tPhase\tFrequency [GHz]\tPower [dBm]\n")
+    def freqSweepDone(self):
+        # will be called after every complete freq sweep
+        self.clearPlotData()
+
+    def getAngleRange(self) -> np.ndarray:
+        # Sample angles in deg from the angle widgets, including the end angle
+        angleFrom = float(self.ui.sampleAngleFrom.text())
+        angleTo = float(self.ui.sampleAngleTo.text())
+        angleStep = abs(float(self.ui.spinBoxAngleStep.value()))
+        if angleStep == 0:
+            return np.array([angleFrom])
+        if angleTo < angleFrom:
+            angleStep = -angleStep
+        return np.arange(angleFrom, angleTo + angleStep / 2, angleStep)
+
+    def startFieldAngDep(self, freqSweepData=None, measType="FieldAngDep"):
+        try:
+            angles = self.getAngleRange()
+        except ValueError as e:
+            print("Invalid angle range:", e)
+            return
+
+        self.newDataFile(measType)
+        self.gatherInfos()
+        self.infos["angles"] = angles
+        if freqSweepData is not None:
+            self.infos["FreqSweep"] = freqSweepData
+        self.setCheckpoint(measType)
+        self.openDataFile(("field", "x", "y", "phase", "angle", "freq", "pow"))
+        self.runAngDep()
         self.clearPlotData()
 
         self.ExcelWriter.addTableRow(self.infos)
 
-    def freqSweepDone(self):
-        # will be called after every complete freq sweep
+    def runAngDep(self):
+        self.measThread = AngularDependence(self.Magnet, self.TslMeter, self.FreqGen, self.LockIn, self.infos, self.Stage)
+        self.measThread.start()
+        self.measThread.angDataOutSig.connect(self.getAngDepData)
+        self.measThread.fieldMoveSig.connect(self.isFieldMoving)
+        self.measThread.angleDoneSig.connect(self.freqSweepDone)
+        self.measThread.errorSig.connect(self.errorMSG)
+        self.measThread.doneSig.connect(self.measurementDone)
+        self.measThread.finished.connect(self.closeOutPutFile)
+
+        self.ui.progressBar.setMaximum(99)
+
+    def setCheckpoint(self, measType:str):
+        # Let the measurement thread keep a checkpoint next to the data file, see resumeMeasurement
+        self.infos["measType"] = measType
+        self.infos["checkpoint"] = self.outputName + ".checkpoint"
+
+    def resumeMeasurement(self):
+        # Continue an interrupted measurement after the last point in its data file
+        fname = QFileDialog.getOpenFileName(self, 'Open checkpoint', '', 'Checkpoint (*.checkpoint)')
+        if not fname[0]:
+            return
+        state = Checkpoint.load(fname[0])
+
+        self.infos = state["infos"]
+        self.infos["calibration"] = self.calibration
+        self.infos["checkpoint"] = fname[0]
+        self.infos["resume"] = {"angleIndex": state["angleIndex"], "freqIndex": state["freqIndex"],
+                                "fieldIndex": state["fieldIndex"], "phase": state["phase"]}
+
+        try:
+            self.outputFile.close()
+        except:
+            pass
+        self.outputName = self.infos["FName"]
+        self.openDataFile(self.infos["columns"], mode="a")
         self.clearPlotData()
 
-    def startFieldAngDep(self):
-        return
+        measType = self.infos["measType"]
+        print("Resuming", measType, "in", self.outputName, "from", self.infos["resume"])
+        if measType == "FieldSweep":
+            self.runFieldSweep()
+        elif measType == "FreqSweep":
+            self.runFreqSweep()
+        elif measType in ("FieldAngDep", "FreqAngDep"):
+            self.runAngDep()
+        else:
+            raise ValueError("Unknown measurement type in checkpoint: " + measType)
 
     def startFreqAngDep(self):
-        return
+        fname = QFileDialog.getOpenFileName(self, 'Open Frequency list', '/home')
+        if fname[0]:
+            freqSweepData = np.loadtxt(fname[0], ndmin=2) # Keep (freq, pow) rows for a single line file
+        else:
+            return
+
+        if self.config["R&S-Frequency Generator"].getboolean("Group by circulator", False):
+            freqSweepData, saved = self.Umschalter.scheduleFrequencies(freqSweepData, self.FreqGen.switchTime)
+            print(f"Frequencies grouped by circulator band, expected to save {saved:.1f} s of switching per angle")
+
+        self.startFieldAngDep(freqSweepData, "FreqAngDep")
 
     def clearPlotData(self):
         self.plotData = {}
@@ -345,7 +485,7 @@ class MyForm(QMainWindow):
             self.ui.graphicsView.plotY.clear()
             self.plotYState = False
 
-    def getSweepData(self, data:dict):
+    def plotSweepData(self, data:dict):
         self.field = data["field"]
         self.ui.fieldlabel.setText(str(self.field) + " [mT]")
 
@@ -355,16 +495,25 @@ class MyForm(QMainWindow):
         self.plotData["y"].append(float(data["y"]))
         self.plotData["phase"].append(float(data["phase"]))
 
-        self.outputFile.write(f"{self.field}\t{self.plotData['x'][-1]}\t{self.plotData['y'][-1]}\t{self.plotData['phase'][-1]}\n")
-
         self.updatePlot()
 
+    def getSweepData(self, data:dict):
+        self.plotSweepData(data)
+
+        if "xVar" in data:
+            self.writePoint((self.field, self.plotData['x'][-1], self.plotData['y'][-1], self.plotData['phase'][-1],
+                             data['xVar'], data['yVar'], data['passes']))
+        else:
+            self.writePoint((self.field, self.plotData['x'][-1], self.plotData['y'][-1], self.plotData['phase'][-1]),
+                            data.get("progress"))
+
     def getFreqSweepData(self, data:dict):
         self.field = data["field"]
         self.ui.fieldlabel.setText(str(self.field) + " [mT]")
 
         freq = data['freq']
         pow = data['pow']
+        progress = data.get("progress")
         freq_data = str(freq) + ' GHz at ' + str(pow) + ' dBm'
         self.ui.angle_freq_label.setText(freq_data)
 
@@ -374,10 +523,22 @@ class MyForm(QMainWindow):
         self.plotData["y"].append(float(data["y"]))
         self.plotData["phase"].append(float(data["phase"]))
 
-        self.outputFile.write(f"{self.field}\t{self.plotData['x'][-1]}\t{self.plotData['y'][-1]}\t{self.plotData['phase'][-1]}\t{freq}\t{pow}\n")
+        self.writePoint((self.field, self.plotData['x'][-1], self.plotData['y'][-1], self.plotData['phase'][-1], freq, pow),
+                        progress)
 
         self.updatePlot()
 
+    def getAngDepData(self, data:dict):
+        self.plotSweepData(data)
+
+        angle = data["angle"]
+        freq = data["freq"]
+        pow = data["pow"]
+        self.ui.angle_freq_label.setText(f"{angle} ° / {freq} GHz at {pow} dBm")
+
+        self.writePoint((self.field, self.plotData['x'][-1], self.plotData['y'][-1], self.plotData['phase'][-1],
+                         angle, freq, pow), data.get("progress"))
+
     def updatePlot(self):
         # Add functionality to choose what to plot
 
@@ -395,13 +556,30 @@ class MyForm(QMainWindow):
         except:
             pass
         now = datetime.now()
-        name = measType + "_" + now.strftime("%d-%m-%y_%H-%M-%S") + ".dat"
-        self.outputName = name
-        self.outputFile = stack.enter_context(open(name, "x"))
+        fmt = self.config.get("Output", "format", fallback="dat")
+        self.outputName = measType + "_" + now.strftime("%d-%m-%y_%H-%M-%S") + "." + fmt
+
+    def openDataFile(self, columns:tuple, mode:str="x"):
+        # Open the writer for self.outputName, the file extension selects the format (dat or h5)
+        # Call after gatherInfos, the infos are stored in the file header (h5) and the checkpoint
+        # Points are written by a background thread, see BufferedWriter, which also keeps the checkpoint
+        self.infos["columns"] = list(columns)
+        fmt = self.outputName.rsplit(".", 1)[-1]
+        writer = openDataWriter(self.outputName, columns, self.infos, fmt, mode)
+        self.outputFile = stack.enter_context(BufferedWriter(writer,
+                                                             self.config.getfloat("Output", "flush interval [s]", fallback=2.0),
+                                                             self.config.getint("Output", "flush count", fallback=100),
+                                                             Checkpoint(self.infos)))
+
+    def exportDataFile(self):
+        fname = QFileDialog.getOpenFileName(self, 'Open data file', '', 'HDF5 (*.h5)')
+        if fname[0]:
+            print("Exported to", exportText(fname[0]))
 
     def setField(self, val:float):
         self.desiredField = val
-        self.fieldWorker = FieldMove(self.Magnet,self.calibration, self.field, val, channel=2)
+        self.fieldWorker = FieldMove(self.Magnet,self.calibration, self.field, val,
+                                     self.config.getfloat("Magnet Powersupply", "Maximum field rate [mT/s]", fallback=25), channel=2)
         self.fieldWorker.start()
 
     def changePolarisation(self, pol:str):
@@ -433,27 +611,46 @@ class MyForm(QMainWindow):
             "Current Limit [A]": 60,
             "Allow negative current?": False,
             "Calibration-File": "magnet-calib.dat",
-            "Maximum field rate [mT/s]": 50
+            "Maximum field rate [mT/s]": 50,
+            "Ramp rate [mT/s]": 0
         }
 
         config["Lock-In"] = {
             "Time Constant [ms]": 100,
             "Sensitivity [mV]": 1,
-            "Modulation Frequency [kHz]": 3
+            "Modulation Frequency [kHz]": 3,
+            "Maximum settle time [TC]": 7,
+            "Settle tolerance [noise]": 3,
+            "Target SNR": 20
         }
 
         config["R&S-Frequency Generator"] = {
-            "address": 'GPIB0::28::INSTR'
+            "address": 'GPIB0::28::INSTR',
+            "Group by circulator": False,
+            "List mode": False,
+            "List trigger": "bus"
         }
 
         config["Hall Sensor"] = {
-            "address": 'GPIB0::10::INSTR'
+            "address": 'GPIB0::10::INSTR',
+            "sample rate [Hz]": 10
         }
 
         config["Keithley 2000"] = {
             "address": 'GPIB0::16::INSTR'
         }
 
+        config["Rotation Stage"] = {
+            "type": "Simulator",
+            "speed [deg/s]": 10
+        }
+
+        config["Output"] = {
+            "format": "dat",
+            "flush interval [s]": 2,
+            "flush count": 100
+        }
+
         with open("config.ini", "w") as f:
             config.write(f)
 
@@ -104,6 +104,8 @@ class Ui_MainWindow(object):
         self.comboBox.addItem("")
         self.comboBox.addItem("")
         self.comboBox.addItem("")
+        self.comboBox.addItem("")
+        self.comboBox.addItem("")
         self.formLayout_2.setWidget(0, QtWidgets.QFormLayout.SpanningRole, self.comboBox)
         self.timedelaycheckbox = QtWidgets.QCheckBox(self.dockWidgetContents_3)
         self.timedelaycheckbox.setObjectName("timedelaycheckbox")
@@ -207,6 +209,7 @@ class Ui_MainWindow(object):
         self.comboBox_sweepDirection.setObjectName("comboBox_sweepDirection")
         self.comboBox_sweepDirection.addItem("")
         self.comboBox_sweepDirection.addItem("")
+        self.comboBox_sweepDirection.addItem("")
         self.formLayout_4.setWidget(2, QtWidgets.QFormLayout.FieldRole, self.comboBox_sweepDirection)
         self.label_6 = QtWidgets.QLabel(self.dockWidgetContents_5)
         self.label_6.setObjectName("label_6")
@@ -304,12 +307,18 @@ class Ui_MainWindow(object):
         self.actionVNA.setObjectName("actionVNA")
         self.actionOPEN_NEW_WINDOW_TO_SELECT_EITHER_VNA_OR_LOCK_IN = QtWidgets.QAction(MainWindow)
         self.actionOPEN_NEW_WINDOW_TO_SELECT_EITHER_VNA_OR_LOCK_IN.setObjectName("actionOPEN_NEW_WINDOW_TO_SELECT_EITHER_VNA_OR_LOCK_IN")
+        self.actionResume_Measurement = QtWidgets.QAction(MainWindow)
+        self.actionResume_Measurement.setObjectName("actionResume_Measurement")
+        self.actionExport_Data = QtWidgets.QAction(MainWindow)
+        self.actionExport_Data.setObjectName("actionExport_Data")
         self.logBookDock.raise_()
         self.magnetfieldock.raise_()
         self.measurementSettingsdock.raise_()
         self.menuAnalyser.addAction(self.actionOPEN_NEW_WINDOW_TO_SELECT_EITHER_VNA_OR_LOCK_IN)
         self.menuSettings.addAction(self.actionMagnet_Powersupply)
         self.menuSettings.addAction(self.menuAnalyser.menuAction())
+        self.menuTools.addAction(self.actionResume_Measurement)
+        self.menuTools.addAction(self.actionExport_Data)
         self.menubar.addAction(self.menuSettings.menuAction())
         self.menubar.addAction(self.menuTools.menuAction())
 
@@ -335,6 +344,8 @@ class Ui_MainWindow(object):
         self.comboBox.setItemText(1, _translate("MainWindow", "Frequency Sweep"))
         self.comboBox.setItemText(2, _translate("MainWindow", "Angular dependence Field-Domain"))
         self.comboBox.setItemText(3, _translate("MainWindow", "Angular dependence Frequency-Domain"))
+        self.comboBox.setItemText(4, _translate("MainWindow", "Field Sweep (continuous ramp)"))
+        self.comboBox.setItemText(5, _translate("MainWindow", "Field Sweep (adaptive refinement)"))
         self.timedelaycheckbox.setText(_translate("MainWindow", "Time delay"))
         self.timedelayedit.setPlaceholderText(_translate("MainWindow", "Delay in [s]; decimals allowed"))
         self.label_3.setText(_translate("MainWindow", "Time constant:"))
@@ -354,6 +365,7 @@ class Ui_MainWindow(object):
         self.calcsteplabel.setText(_translate("MainWindow", "CALC amount of STEPs"))
         self.comboBox_sweepDirection.setItemText(0, _translate("MainWindow", "Up (low field -> high field)"))
         self.comboBox_sweepDirection.setItemText(1, _translate("MainWindow", "Down (high field -> low field)"))
+        self.comboBox_sweepDirection.setItemText(2, _translate("MainWindow", "Alternating (up/down per spectrum)"))
         self.label_6.setText(_translate("MainWindow", "Sweep direction:"))
         self.measurementSettingsdock.setWindowTitle(_translate("MainWindow", "Measurement Settings"))
         self.label_5.setText(_translate("MainWindow", "Sample Angle:"))
@@ -370,4 +382,6 @@ class Ui_MainWindow(object):
         self.actionLock_In.setText(_translate("MainWindow", "Lock-In"))
         self.actionVNA.setText(_translate("MainWindow", "VNA"))
         self.actionOPEN_NEW_WINDOW_TO_SELECT_EITHER_VNA_OR_LOCK_IN.setText(_translate("MainWindow", "OPEN NEW WINDOW TO SELECT EITHER VNA OR LOCK-IN"))
+        self.actionResume_Measurement.setText(_translate("MainWindow", "Resume measurement..."))
+        self.actionExport_Data.setText(_translate("MainWindow", "Export data file as text..."))
 from Lib.customwidgets import Plot_pyqtgraph, SpinBox_custom